@@ -0,0 +1,270 @@
+# benchmark.py - Throughput/latency benchmark for chatbot.py's LLM client and HTTP routes.
+#
+# Runs against the bundled mock server by default (no LM Studio needed) and prints a JSON
+# report that can be committed or diffed between versions:
+#
+#   python benchmark.py --targets client,client-stream,flask,flask-stream --concurrency 16 --requests 200
+#   python benchmark.py --endpoint http://127.0.0.1:1234/v1/chat/completions   # live server
+#   python benchmark.py --startup --budget-ms 800   # headless import time; exits 1 over budget
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+try:
+    import resource # Unix only; used for peak RSS
+except ImportError:
+    resource = None
+
+from mock_llm_server import start_mock_server
+
+TARGETS = ("client", "client-stream", "flask", "flask-stream")
+GUI_ONLY_MODULES = ("tkinter", "ttkthemes", "speech_recognition", "pyttsx3")
+
+# Run in a fresh interpreter so every sample pays the full import cost, as a server host does.
+STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import chatbot
+elapsed = time.perf_counter() - started
+print(json.dumps({"import_ms": elapsed * 1000, "modules": len(sys.modules),
+                  "gui_modules": sorted(name for name in %r if name in sys.modules)}))
+""" % (GUI_ONLY_MODULES,)
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list.
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024) if platform.system() == "Darwin" else peak / 1024, 1) # bytes on macOS, KiB elsewhere
+
+
+def summarize(samples, elapsed_seconds):
+    latencies = sorted(sample["latency"] for sample in samples if sample["ok"])
+    ttfts = sorted(sample["ttft"] for sample in samples if sample["ok"] and sample["ttft"] is not None)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 2)
+
+    report = {
+        "requests": len(samples),
+        "errors": sum(1 for sample in samples if not sample["ok"]),
+        "elapsed_seconds": round(elapsed_seconds, 3),
+        "requests_per_second": round(len(latencies) / elapsed_seconds, 2) if elapsed_seconds > 0 else None,
+        "latency_ms": {"p50": ms(percentile(latencies, 0.50)), "p95": ms(percentile(latencies, 0.95)),
+                       "p99": ms(percentile(latencies, 0.99)), "max": ms(latencies[-1] if latencies else None)},
+        "peak_rss_mb": peak_rss_mb()
+    }
+    if ttfts:
+        report["ttft_ms"] = {"p50": ms(percentile(ttfts, 0.50)), "p95": ms(percentile(ttfts, 0.95)),
+                             "p99": ms(percentile(ttfts, 0.99))}
+    return report
+
+
+def run_load(request_fn, total_requests, concurrency):
+    samples = []
+    samples_lock = threading.Lock()
+
+    def one(index):
+        started = time.perf_counter()
+        try:
+            ok, first_token_at = request_fn(index)
+        except Exception:
+            ok, first_token_at = False, None
+        sample = {"ok": ok, "latency": time.perf_counter() - started,
+                  "ttft": None if first_token_at is None else first_token_at - started}
+        with samples_lock:
+            samples.append(sample)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bench") as pool:
+        list(pool.map(one, range(total_requests)))
+    return summarize(samples, time.perf_counter() - started)
+
+
+def benchmark_prompt(index):
+    # Unique per request so neither the response cache nor the local math engine short-circuits it.
+    return f"Benchmark request {index}: explain the chain rule with an example."
+
+
+def make_request_fn(target, chatbot, flask_url):
+    history = lambda index: [{"role": "system", "content": "You are a benchmark target."},
+                             {"role": "user", "content": benchmark_prompt(index)}]
+
+    if target == "client":
+        def request_fn(index):
+            response = chatbot.get_llm_response(history(index), chatbot.TEMPERATURE, chatbot.MAX_TOKENS, use_cache=False)
+            return not chatbot._is_llm_error(response), None
+    elif target == "client-stream":
+        def request_fn(index):
+            first_token_at = None
+            chunks = []
+            for delta in chatbot.stream_llm_response(history(index), chatbot.TEMPERATURE, chatbot.MAX_TOKENS, use_cache=False):
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                chunks.append(delta)
+            return not chatbot._is_llm_error(chatbot._join_stream(chunks)), first_token_at
+    elif target == "flask":
+        session = requests.Session()
+        def request_fn(index):
+            response = session.post(f"{flask_url}/get_response_http",
+                                    json={"message": benchmark_prompt(index), "use_cache": False}, timeout=300)
+            return response.ok and response.json().get("status") == "success", None
+    elif target == "flask-stream":
+        session = requests.Session()
+        def request_fn(index):
+            first_token_at = None
+            with session.post(f"{flask_url}/get_response_stream", stream=True, timeout=300,
+                              json={"message": benchmark_prompt(index), "use_cache": False}) as response:
+                if not response.ok:
+                    return False, None
+                for line in response.iter_lines():
+                    if first_token_at is None and line.startswith(b'data: {"delta"'):
+                        first_token_at = time.perf_counter()
+            return first_token_at is not None, first_token_at
+    else:
+        raise ValueError(f"Unknown target {target!r}; choose from {', '.join(TARGETS)}")
+    return request_fn
+
+
+def start_flask_server(chatbot):
+    from werkzeug.serving import make_server
+    server = make_server("127.0.0.1", 0, chatbot.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True, name="bench-flask").start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def measure_startup(runs):
+    # Imports chatbot (without starting the GUI) in `runs` fresh interpreters and reports import
+    # time, total process time, module count, peak RSS and any GUI/audio modules that got loaded.
+    import_ms, process_ms, samples = [], [], []
+    for _ in range(runs):
+        started = time.perf_counter()
+        completed = subprocess.run([sys.executable, "-c", STARTUP_PROBE], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   capture_output=True, text=True, check=True)
+        process_ms.append((time.perf_counter() - started) * 1000)
+        sample = json.loads(completed.stdout.strip().splitlines()[-1])
+        import_ms.append(sample["import_ms"])
+        samples.append(sample)
+    import_ms.sort()
+    process_ms.sort()
+    child_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss if resource is not None else None
+    return {
+        "runs": runs,
+        "import_ms": {"p50": round(percentile(import_ms, 0.50), 1), "max": round(import_ms[-1], 1)},
+        "process_ms": {"p50": round(percentile(process_ms, 0.50), 1), "max": round(process_ms[-1], 1)},
+        "modules": samples[-1]["modules"],
+        "peak_rss_mb": None if child_peak is None else
+                       round(child_peak / (1024 * 1024) if platform.system() == "Darwin" else child_peak / 1024, 1),
+        "gui_modules_loaded": sorted({name for sample in samples for name in sample["gui_modules"]})
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark chatbot.py against a mock or live LLM endpoint.")
+    parser.add_argument("--targets", default=",".join(TARGETS), help=f"Comma-separated subset of: {', '.join(TARGETS)}")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100, help="Requests per target.")
+    parser.add_argument("--warmup", type=int, default=2, help="Untimed requests per target (lazy imports, pools).")
+    parser.add_argument("--endpoint", help="Live LLM endpoint; when omitted a mock server is started.")
+    parser.add_argument("--mock-delay", type=float, default=0.05, help="Mock server delay before the first token (s).")
+    parser.add_argument("--mock-tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--mock-response-tokens", type=int, default=32)
+    parser.add_argument("--output", help="Write the JSON report to this file as well as stdout.")
+    parser.add_argument("--startup", action="store_true",
+                        help="Measure headless import time and footprint instead of request throughput.")
+    parser.add_argument("--startup-runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float,
+                        help="With --startup, exit with status 1 if the median import time exceeds this.")
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        startup = measure_startup(max(1, args.startup_runs))
+        failures = []
+        if startup["gui_modules_loaded"]:
+            failures.append(f"GUI/audio modules imported at startup: {', '.join(startup['gui_modules_loaded'])}")
+        if args.budget_ms is not None and startup["import_ms"]["p50"] > args.budget_ms:
+            failures.append(f"median import time {startup['import_ms']['p50']} ms exceeds budget {args.budget_ms} ms")
+        report = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "python": platform.python_version(),
+                  "startup": startup, "budget_ms": args.budget_ms, "failures": failures}
+        output = json.dumps(report, indent=2)
+        print(output)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as report_file:
+                report_file.write(output + "\n")
+        sys.exit(1 if failures else 0)
+
+    targets = [target.strip() for target in args.targets.split(",") if target.strip()]
+    mock_server = None
+    endpoint = args.endpoint
+    if endpoint is None:
+        mock_server = start_mock_server(delay=args.mock_delay, tokens_per_second=args.mock_tokens_per_second,
+                                        response_tokens=args.mock_response_tokens)
+        endpoint = mock_server.endpoint
+
+    import chatbot
+    # Point the shared client at the benchmark endpoint and let it run at full concurrency.
+    chatbot.llm_client = chatbot.LLMClient(endpoint, chatbot.MODEL_NAME, chatbot.API_KEY,
+                                           max_in_flight=args.concurrency, pool_size=args.concurrency,
+                                           connect_timeout=chatbot.LLM_CONNECT_TIMEOUT,
+                                           read_timeout=chatbot.LLM_READ_TIMEOUT,
+                                           queue_timeout=chatbot.LLM_QUEUE_TIMEOUT)
+    if chatbot.request_scheduler is not None:
+        # The scheduler caps parallel upstream calls as well, so it is resized to match.
+        chatbot.request_scheduler.close()
+        chatbot.request_scheduler = chatbot.MicroBatchScheduler(chatbot.SCHEDULER_WINDOW_MS,
+                                                                chatbot.SCHEDULER_MAX_BATCH_SIZE, args.concurrency,
+                                                                chatbot.LLM_QUEUE_TIMEOUT)
+
+    flask_server, flask_url = (None, None)
+    if any(target.startswith("flask") for target in targets):
+        flask_server, flask_url = start_flask_server(chatbot)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "settings": {"concurrency": args.concurrency, "requests": args.requests, "warmup": args.warmup,
+                     "endpoint": "mock" if mock_server else endpoint,
+                     "mock": None if mock_server is None else {
+                         "delay": args.mock_delay, "tokens_per_second": args.mock_tokens_per_second,
+                         "response_tokens": args.mock_response_tokens},
+                     "scheduler": None if chatbot.request_scheduler is None else {
+                         "window_ms": chatbot.SCHEDULER_WINDOW_MS, "max_batch_size": chatbot.SCHEDULER_MAX_BATCH_SIZE,
+                         "max_parallel": chatbot.request_scheduler.max_parallel}},
+        "results": {}
+    }
+    try:
+        for target in targets:
+            request_fn = make_request_fn(target, chatbot, flask_url)
+            for index in range(args.warmup):
+                request_fn(-1 - index)
+            report["results"][target] = run_load(request_fn, args.requests, args.concurrency)
+    finally:
+        if flask_server is not None:
+            flask_server.shutdown()
+        if mock_server is not None:
+            mock_server.shutdown()
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as report_file:
+            report_file.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
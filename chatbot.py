@@ -1,113 +1,2625 @@
 # chatbot.py (Production-Ready - Fully Debugged and Working with Speech Toggle)
-import tkinter as tk
-from tkinter import scrolledtext, messagebox, font as tkFont
 import threading
+import asyncio
+import argparse
 import logging
+import logging.handlers
 import configparser
-from ttkthemes import ThemedTk
-import speech_recognition as sr
-import pyttsx3
-# import faiss  # Uncomment if using FAISS for RAG or vector search
-# import numpy as np # Uncomment if using numpy with FAISS or other numerical tasks
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, g
 import requests
+from requests.adapters import HTTPAdapter
 import queue # Though not directly used by Tkinter UI for receiving, kept for Flask/future
 import json
+import os
 import time
+import hashlib
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import importlib.util
+import ast
+import math
+import operator
+import re
+import random
+import heapq
+import uuid
+import bisect
+import zlib
+import atexit
+from contextlib import contextmanager
+
+# The GUI (tkinter, ttkthemes) and speech (speech_recognition, pyttsx3) stacks are imported on
+# first use, so headless servers start quickly and need neither a display nor audio libraries.
+# numpy, faiss and sentence_transformers are likewise only loaded by the semantic answer index.
+tk = scrolledtext = messagebox = tkFont = ThemedTk = None
+sr = None
+
+
+def _import_gui_stack():
+    global tk, scrolledtext, messagebox, tkFont, ThemedTk
+    import tkinter as tk
+    from tkinter import scrolledtext, messagebox, font as tkFont
+    from ttkthemes import ThemedTk
+
+
+def _import_speech_recognition():
+    global sr
+    import speech_recognition as sr
+
+
+def setup_logging(path, level, max_bytes, backup_count):
+    # Request threads only put records on a queue; a background QueueListener does the
+    # formatting and disk writes, and the file is rotated once it reaches max_bytes.
+    file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count,
+                                                        encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener.start()
+    atexit.register(listener.stop) # Flushes queued records on exit
+    return listener
+
+
+# Configuration File Handling
+config = configparser.ConfigParser()
+config_found = bool(config.read('config.ini'))
 
 # Configure Logging
-logging.basicConfig(filename='chatbot.log', level=logging.DEBUG,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+LOG_FILE = config.get('LOGGING', 'file', fallback='chatbot.log')
+LOG_LEVEL = config.get('LOGGING', 'level', fallback='INFO').strip().upper()
+LOG_MAX_BYTES = config.getint('LOGGING', 'max_bytes', fallback=10 * 1024 * 1024)
+LOG_BACKUP_COUNT = config.getint('LOGGING', 'backup_count', fallback=5)
+LOG_PAYLOAD_SAMPLE_RATE = config.getfloat('LOGGING', 'payload_sample_rate', fallback=0.0)
+if multiprocessing.parent_process() is None: # Math worker processes re-import this module; only the parent owns the log file
+    setup_logging(LOG_FILE, getattr(logging, LOG_LEVEL, logging.INFO), LOG_MAX_BYTES, LOG_BACKUP_COUNT)
+
+if not config_found:
+    logging.warning("config.ini not found. Using default fallback values.")
+    # Create a default config object if file not found
+    config['LLM'] = {
+        'endpoint': "http://127.0.0.1:1234/v1/chat/completions",
+        'model_name': "lmstudio-community/Meta-Llama-3-8B-Instruct-GGUF", # A common default
+        'api_key': "lm-studio", # Default for LM Studio
+        'temperature': '1',
+        'max_tokens': '4096',
+        'stream': 'true',
+        'max_in_flight': '4',
+        'pool_size': '8',
+        'connect_timeout': '5',
+        'read_timeout': '150',
+        'queue_timeout': '60',
+        'coalesce': 'true' # Identical concurrent requests share one upstream call
+    }
+    config['SERVER'] = {
+        'host': '0.0.0.0',
+        'port': '5000',
+        'async_max_in_flight': '64'
+    }
+    config['ROUTER'] = {
+        'strategy': 'least_outstanding', # or 'weighted'; only used with [BACKEND:<name>] sections
+        'failure_threshold': '3',
+        'cooldown_seconds': '30',
+        'health_check_interval': '15',
+        'long_prompt_chars': '400'
+    }
+    config['SCHEDULER'] = {
+        'enabled': 'true',
+        'window_ms': '10', # How long to gather near-simultaneous requests before dispatching
+        'max_batch_size': '8',
+        'max_parallel': '4'
+    }
+    config['CACHE'] = {
+        'enabled': 'true',
+        'max_entries': '1024',
+        'ttl_seconds': '3600',
+        'db_path': '' # e.g. response_cache.sqlite3 to persist across restarts
+    }
+    config['MATH'] = {
+        'fast_path': 'true',
+        'timeout_seconds': '2',
+        'max_input_length': '200'
+    }
+    config['SEMANTIC'] = {
+        'enabled': 'true',
+        'mode': 'reuse', # 'reuse' answers paraphrases from the index, 'context' passes the match to the model
+        'threshold': '0.9',
+        'max_entries': '10000',
+        'embedding_model': 'hashing', # or a sentence-transformers model such as all-MiniLM-L6-v2
+        'index_backend': 'auto', # 'faiss' if installed, else 'numpy'
+        'index_path': '' # e.g. semantic_index to persist semantic_index.npy/.sqlite3 across restarts
+    }
+    config['HISTORY'] = {
+        'mode': 'window', # 'window' drops old turns, 'summary' folds them into a model-written summary
+        'max_context_tokens': '3072',
+        'chars_per_token': '4',
+        'summary_max_tokens': '256'
+    }
+    config['SESSIONS'] = {
+        'enabled': 'true',
+        'max_sessions': '5000',
+        'idle_timeout_seconds': '1800',
+        'max_context_tokens': '1024',
+        'db_path': '' # e.g. sessions.sqlite3 to keep sessions across restarts
+    }
+    config['STT'] = {
+        'backend': 'vosk', # 'vosk' or 'sphinx' (offline), 'google' (online)
+        'vosk_model_path': 'models/vosk-model-small-en-us-0.15',
+        'allow_online_fallback': 'false', # Use Google if the local backend cannot start
+        'mode': 'push_to_talk', # or 'continuous'
+        'calibration_seconds': '0.5',
+        'listen_timeout': '5',
+        'phrase_time_limit': '10'
+    }
+    config['TTS'] = {
+        'enabled_by_default': 'true',
+        'voice_preference': 'male', # 'male', 'female', or part of a voice name
+        'rate': '160'
+    }
+    config['GUI'] = {
+        'max_rendered_messages': '200', # Older messages are removed from the window (not the transcript)
+        'transcript_path': 'transcript.log',
+        'stream_refresh_ms': '50'
+    }
+    config['LOGGING'] = {
+        'file': 'chatbot.log',
+        'level': 'INFO',
+        'max_bytes': str(10 * 1024 * 1024),
+        'backup_count': '5',
+        'payload_sample_rate': '0' # Fraction of LLM requests whose full payload is logged
+    }
+    with open('config.ini', 'w') as configfile: # Create a default config.ini
+        config.write(configfile)
+    logging.info("Created a default config.ini with LLM and TTS settings.")
+
+
+LLM_ENDPOINT = config.get('LLM', 'endpoint', fallback="http://127.0.0.1:1234/v1/chat/completions")
+MODEL_NAME = config.get('LLM', 'model_name', fallback="lmstudio-community/Meta-Llama-3-8B-Instruct-GGUF")
+API_KEY = config.get('LLM', 'api_key', fallback="lm-studio")
+TEMPERATURE = config.getfloat('LLM', 'temperature', fallback=0.7)
+MAX_TOKENS = config.getint('LLM', 'max_tokens', fallback=2048)
+STREAM_RESPONSES = config.getboolean('LLM', 'stream', fallback=True)
+LLM_MAX_IN_FLIGHT = config.getint('LLM', 'max_in_flight', fallback=4)
+LLM_POOL_SIZE = config.getint('LLM', 'pool_size', fallback=8)
+LLM_CONNECT_TIMEOUT = config.getfloat('LLM', 'connect_timeout', fallback=5.0)
+LLM_READ_TIMEOUT = config.getfloat('LLM', 'read_timeout', fallback=150.0)
+LLM_QUEUE_TIMEOUT = config.getfloat('LLM', 'queue_timeout', fallback=60.0)
+LLM_COALESCE = config.getboolean('LLM', 'coalesce', fallback=True)
+
+SERVER_HOST = config.get('SERVER', 'host', fallback='0.0.0.0')
+SERVER_PORT = config.getint('SERVER', 'port', fallback=5000)
+ASYNC_MAX_IN_FLIGHT = config.getint('SERVER', 'async_max_in_flight', fallback=64)
+
+ROUTER_STRATEGY = config.get('ROUTER', 'strategy', fallback='least_outstanding').strip().lower()
+ROUTER_FAILURE_THRESHOLD = config.getint('ROUTER', 'failure_threshold', fallback=3)
+ROUTER_COOLDOWN_SECONDS = config.getfloat('ROUTER', 'cooldown_seconds', fallback=30.0)
+ROUTER_HEALTH_CHECK_INTERVAL = config.getfloat('ROUTER', 'health_check_interval', fallback=15.0)
+ROUTER_LONG_PROMPT_CHARS = config.getint('ROUTER', 'long_prompt_chars', fallback=400)
+
+CACHE_ENABLED = config.getboolean('CACHE', 'enabled', fallback=True)
+CACHE_MAX_ENTRIES = config.getint('CACHE', 'max_entries', fallback=1024)
+CACHE_TTL_SECONDS = config.getfloat('CACHE', 'ttl_seconds', fallback=3600)
+CACHE_DB_PATH = config.get('CACHE', 'db_path', fallback='').strip() or None
+
+SCHEDULER_ENABLED = config.getboolean('SCHEDULER', 'enabled', fallback=True)
+SCHEDULER_WINDOW_MS = config.getfloat('SCHEDULER', 'window_ms', fallback=10.0)
+SCHEDULER_MAX_BATCH_SIZE = config.getint('SCHEDULER', 'max_batch_size', fallback=8)
+SCHEDULER_MAX_PARALLEL = config.getint('SCHEDULER', 'max_parallel', fallback=LLM_MAX_IN_FLIGHT)
+
+MATH_FAST_PATH_ENABLED = config.getboolean('MATH', 'fast_path', fallback=True)
+MATH_TIMEOUT_SECONDS = config.getfloat('MATH', 'timeout_seconds', fallback=2.0)
+MATH_MAX_INPUT_LENGTH = config.getint('MATH', 'max_input_length', fallback=200)
+
+SEMANTIC_ENABLED = config.getboolean('SEMANTIC', 'enabled', fallback=True)
+SEMANTIC_MODE = config.get('SEMANTIC', 'mode', fallback='reuse').strip().lower()
+SEMANTIC_THRESHOLD = config.getfloat('SEMANTIC', 'threshold', fallback=0.9)
+SEMANTIC_MAX_ENTRIES = config.getint('SEMANTIC', 'max_entries', fallback=10000)
+SEMANTIC_EMBEDDING_MODEL = config.get('SEMANTIC', 'embedding_model', fallback='hashing').strip()
+SEMANTIC_INDEX_BACKEND = config.get('SEMANTIC', 'index_backend', fallback='auto').strip().lower()
+SEMANTIC_INDEX_PATH = config.get('SEMANTIC', 'index_path', fallback='').strip() or None
+
+HISTORY_MODE = config.get('HISTORY', 'mode', fallback='window').strip().lower()
+HISTORY_MAX_CONTEXT_TOKENS = config.getint('HISTORY', 'max_context_tokens', fallback=3072)
+HISTORY_CHARS_PER_TOKEN = config.getint('HISTORY', 'chars_per_token', fallback=4)
+HISTORY_SUMMARY_MAX_TOKENS = config.getint('HISTORY', 'summary_max_tokens', fallback=256)
+
+SESSIONS_ENABLED = config.getboolean('SESSIONS', 'enabled', fallback=True)
+SESSIONS_MAX_SESSIONS = config.getint('SESSIONS', 'max_sessions', fallback=5000)
+SESSIONS_IDLE_TIMEOUT_SECONDS = config.getint('SESSIONS', 'idle_timeout_seconds', fallback=1800)
+SESSIONS_MAX_CONTEXT_TOKENS = config.getint('SESSIONS', 'max_context_tokens', fallback=1024)
+SESSIONS_DB_PATH = config.get('SESSIONS', 'db_path', fallback='').strip() or None
+
+STT_BACKEND = config.get('STT', 'backend', fallback='vosk').strip().lower()
+STT_VOSK_MODEL_PATH = config.get('STT', 'vosk_model_path', fallback='models/vosk-model-small-en-us-0.15')
+STT_ALLOW_ONLINE_FALLBACK = config.getboolean('STT', 'allow_online_fallback', fallback=False)
+STT_CONTINUOUS = config.get('STT', 'mode', fallback='push_to_talk').strip().lower() == 'continuous'
+STT_CALIBRATION_SECONDS = config.getfloat('STT', 'calibration_seconds', fallback=0.5)
+STT_LISTEN_TIMEOUT = config.getfloat('STT', 'listen_timeout', fallback=5)
+STT_PHRASE_TIME_LIMIT = config.getfloat('STT', 'phrase_time_limit', fallback=10)
+
+TTS_ENABLED_DEFAULT = config.getboolean('TTS', 'enabled_by_default', fallback=True)
+TTS_VOICE_PREF = config.get('TTS', 'voice_preference', fallback='male').lower()
+TTS_RATE = config.getint('TTS', 'rate', fallback=160)
+
+GUI_MAX_RENDERED_MESSAGES = max(1, config.getint('GUI', 'max_rendered_messages', fallback=200))
+GUI_TRANSCRIPT_PATH = config.get('GUI', 'transcript_path', fallback='transcript.log').strip() or None
+GUI_STREAM_REFRESH_MS = config.getint('GUI', 'stream_refresh_ms', fallback=50)
+
+
+# Flask App Setup
+app = Flask(__name__)
+
+# Global Queue for Thread-Safe Communication (primarily for Flask or other integrations)
+response_queue = queue.Queue()
+
+# -----------------------------------------------------------------------------
+# Metrics and Timing
+# -----------------------------------------------------------------------------
+_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for name, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+class MetricsRegistry:
+    # Process-wide counters and latency histograms, rendered in the Prometheus text format
+    # by the /metrics route. An update is a dict lookup and a bisect under a short lock,
+    # so it is cheap enough to call on every request and every pipeline stage.
+    def __init__(self, buckets=_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counters = {} # (name, labels) -> value
+        self._histograms = {} # (name, labels) -> [bucket_counts, sum, count]
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, [list(value[0]), value[1], value[2]]) for key, value in self._histograms.items())
+        lines, declared = [], set()
+
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            declare(name, "counter")
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), (bucket_counts, total, count) in histograms:
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+metrics.describe("chatbot_stage_duration_seconds", "Time spent in each stage of the request pipeline.")
+metrics.describe("chatbot_llm_requests_total", "Upstream LLM calls by model and outcome.")
+metrics.describe("chatbot_http_request_duration_seconds", "HTTP handler latency (time to response headers).")
+metrics.describe("chatbot_http_requests_total", "HTTP requests by route and status code.")
+
+
+def record_stage(stage, seconds, **labels):
+    # Stages: cache_lookup, queue_wait (scheduler), slot_wait (client semaphore), connect (until
+    # response headers), ttft, generation, tts and stt.
+    metrics.observe("chatbot_stage_duration_seconds", seconds, stage=stage, **labels)
+
+
+@contextmanager
+def timed_stage(stage, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started, **labels)
+
+
+def _should_log_payload():
+    # Full request/response payloads are only logged for a sampled fraction of calls.
+    return LOG_PAYLOAD_SAMPLE_RATE > 0 and random.random() < LOG_PAYLOAD_SAMPLE_RATE
+
+
+# -----------------------------------------------------------------------------
+# LLM Client (shared, pooled connection to the LLM endpoint)
+# -----------------------------------------------------------------------------
+def _extract_llm_content(json_response):
+    # Returns the completion text, or None if the response shape is not recognised.
+    if "choices" in json_response and len(json_response["choices"]) > 0:
+        if "message" in json_response["choices"][0] and "content" in json_response["choices"][0]["message"]:
+             return json_response["choices"][0]["message"]["content"].strip()
+        elif "text" in json_response["choices"][0]: 
+             return json_response["choices"][0]["text"].strip()
+    
+    if "data" in json_response and len(json_response["data"]) > 0 and "content" in json_response["data"][0]:
+        return json_response["data"][0]["content"].strip()
+    return None
+
+
+_SSE_DONE = object() # Returned by _parse_sse_line for the "data: [DONE]" terminator
+
+
+def _parse_sse_line(raw_line):
+    # Parses one line of an OpenAI-compatible server-sent event stream ("data: {...}",
+    # terminated by "data: [DONE]"). Returns the content delta, None, or _SSE_DONE.
+    line = raw_line.decode("utf-8") if isinstance(raw_line, bytes) else raw_line
+    line = line.strip()
+    if not line or line.startswith(":") or not line.startswith("data:"):
+        return None # Blank keep-alive lines, comments and non-data fields
+    payload = line[len("data:"):].strip()
+    if payload == "[DONE]":
+        return _SSE_DONE
+    try:
+        chunk = json.loads(payload)
+    except json.JSONDecodeError as e:
+        logging.warning(f"Skipping malformed stream chunk: {e}. Chunk: {payload}")
+        return None
+    choices = chunk.get("choices") or []
+    if not choices:
+        return None
+    return (choices[0].get("delta") or {}).get("content") or choices[0].get("text")
+
+
+def _iter_sse_deltas(lines):
+    for raw_line in lines:
+        delta = _parse_sse_line(raw_line)
+        if delta is _SSE_DONE:
+            return
+        if delta:
+            yield delta
+
+
+class LLMError(str):
+    # Failure text from the LLM helpers. It displays like any other reply, but callers tell it
+    # apart by type rather than by prefix, so a model answer that happens to start with
+    # "Error:" is not mistaken for a failure, and a stream that broke after a partial answer
+    # (whose last delta is an LLMError) is never cached, indexed or stored. backend_fault is
+    # False for errors raised on this side of the wire (no free local request slot), so the
+    # router does not hold them against the model server.
+    def __new__(cls, text, backend_fault=True):
+        error = super().__new__(cls, text)
+        error.backend_fault = backend_fault
+        return error
+
+
+class LLMClient:
+    # One instance is shared by the GUI and the Flask routes. A requests.Session keeps
+    # connections to the LLM server alive between turns, and a semaphore caps how many
+    # requests may be in flight at once so bursts queue here instead of on the server.
+    def __init__(self, endpoint, model_name, api_key=None, max_in_flight=4, pool_size=8,
+                 connect_timeout=5.0, read_timeout=150.0, queue_timeout=60.0):
+        self.endpoint = endpoint
+        self.model_name = model_name
+        self.timeout = (connect_timeout, read_timeout)
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, max_in_flight))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+        if api_key and api_key != "None" and api_key != "": 
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+
+    def _request_data(self, conversation_history, temperature, max_tokens, stream=False):
+        return {
+            "model": self.model_name,
+            "messages": conversation_history,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": stream
+        }
+
+    def _acquire_slot(self):
+        with timed_stage("slot_wait"):
+            acquired = self._slots.acquire(timeout=self.queue_timeout)
+        if acquired:
+            return True
+        logging.error(f"LLM client: no free request slot after {self.queue_timeout}s.")
+        return False
+
+    def complete(self, conversation_history, temperature, max_tokens):
+        logging.debug("Sending conversation history to LLM...")
+        messages_payload = conversation_history 
+        log_payload = _should_log_payload()
+        if log_payload:
+            logging.info("Payload sent to LLM: %s", json.dumps(messages_payload))
+
+        data = self._request_data(messages_payload, temperature, max_tokens, stream=False)
+
+        if not self._acquire_slot():
+            return LLMError("Error: LLM server is busy. Please try again shortly.", backend_fault=False)
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            response = self.session.post(self.endpoint, data=json.dumps(data), timeout=self.timeout) 
+            response.raise_for_status()
+            json_response = response.json()
+            if log_payload:
+                logging.info("LLM Response JSON: %s", json.dumps(json_response))
+            
+            content = _extract_llm_content(json_response)
+            if content is not None:
+                outcome = "success"
+                return content
+
+            logging.error(f"Unexpected LLM response structure: {json_response}")
+            return LLMError("Error: Could not parse LLM response.")
+
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Error communicating with LLM: {e}")
+            return LLMError(f"Network Error: {e}")
+        except (KeyError, IndexError, TypeError) as e:
+            logging.error(f"Error parsing LLM response: {e}. Response: {json_response if 'json_response' in locals() else 'N/A'}")
+            return LLMError(f"Parsing Error: {e}")
+        except json.JSONDecodeError as e:
+            logging.error(f"Error decoding JSON from LLM: {e}. Response text: {response.text if 'response' in locals() else 'N/A'}")
+            return LLMError(f"JSON Decode Error: {e}")
+        finally:
+            self._slots.release()
+            record_stage("generation", time.perf_counter() - started, model=self.model_name)
+            metrics.inc("chatbot_llm_requests_total", model=self.model_name, outcome=outcome)
+
+    def stream(self, conversation_history, temperature, max_tokens):
+        # Generator counterpart of complete(): yields text deltas as the model produces
+        # them. The request slot is held until the stream ends or the consumer closes it.
+        # Errors are yielded as a final LLMError delta, mirroring complete().
+        logging.debug("Streaming conversation history to LLM...")
+        if _should_log_payload():
+            logging.info("Payload sent to LLM (stream): %s", json.dumps(conversation_history))
+
+        data = self._request_data(conversation_history, temperature, max_tokens, stream=True)
+
+        if not self._acquire_slot():
+            yield LLMError("Error: LLM server is busy. Please try again shortly.", backend_fault=False)
+            return
+        started = time.perf_counter()
+        received_any = False
+        outcome = "error"
+        try:
+            with self.session.post(self.endpoint, data=json.dumps(data), timeout=self.timeout, stream=True) as response:
+                record_stage("connect", time.perf_counter() - started, model=self.model_name)
+                response.raise_for_status()
+                for delta in _iter_sse_deltas(response.iter_lines()):
+                    if not received_any:
+                        received_any = True
+                        record_stage("ttft", time.perf_counter() - started, model=self.model_name)
+                    yield delta
+            outcome = "success"
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Error streaming from LLM: {e}")
+            separator = "\n\n" if received_any else "" # Keep the error apart from partial output
+            yield LLMError(f"{separator}Network Error: {e}")
+        finally:
+            self._slots.release()
+            record_stage("generation", time.perf_counter() - started, model=self.model_name)
+            metrics.inc("chatbot_llm_requests_total", model=self.model_name, outcome=outcome)
+
+    def close(self):
+        self.session.close()
+
+
+# -----------------------------------------------------------------------------
+# Response Cache
+# -----------------------------------------------------------------------------
+def _is_llm_error(llm_response):
+    # The LLM helpers report failures as LLMError text; those must never be cached or reused.
+    return not llm_response or isinstance(llm_response, LLMError)
+
+
+def _join_stream(deltas):
+    # Joins streamed deltas into the full reply. A stream that ended with an error delta
+    # still produces readable text, but the result stays an LLMError.
+    text = "".join(deltas).strip()
+    return LLMError(text) if any(isinstance(delta, LLMError) for delta in deltas) else text
+
+
+def make_cache_key(model_name, conversation_history, temperature, max_tokens):
+    # Whitespace-insensitive hash of everything that determines the completion.
+    normalized_messages = [[message.get("role", ""), " ".join(str(message.get("content", "")).split())]
+                           for message in conversation_history]
+    key_material = json.dumps([model_name, normalized_messages, float(temperature), int(max_tokens)],
+                              separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    # In-memory LRU with TTL in front of the LLM. When db_path is set, entries are also
+    # written to SQLite so they survive restarts; a memory miss falls back to the disk.
+    def __init__(self, max_entries=1024, ttl_seconds=3600, db_path=None, disk_max_entries=100000):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_max_entries = disk_max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict() # key -> (created_at, response)
+        self._lock = threading.Lock()
+        self._db = None
+        self._disk_writes = 0
+        if db_path:
+            try:
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute("CREATE TABLE IF NOT EXISTS responses "
+                                 "(key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL)")
+                self._purge_expired_from_disk()
+                self._db.commit()
+                logging.info(f"Response cache persisted to {db_path}.")
+            except sqlite3.Error as e:
+                logging.error(f"Could not open response cache database {db_path}: {e}. Using memory only.")
+                self._db = None
+
+    def _is_expired(self, created_at):
+        return self.ttl_seconds > 0 and time.time() - created_at > self.ttl_seconds
+
+    def _purge_expired_from_disk(self):
+        if self.ttl_seconds > 0:
+            self._db.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+
+    def _remember(self, key, created_at, response):
+        self._entries[key] = (created_at, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry[0]):
+                del self._entries[key]
+                entry = None
+            if entry is None and self._db is not None:
+                try:
+                    row = self._db.execute("SELECT created_at, response FROM responses WHERE key = ?", (key,)).fetchone()
+                except sqlite3.Error as e:
+                    logging.error(f"Response cache read failed: {e}")
+                    row = None
+                if row is not None and not self._is_expired(row[0]):
+                    entry = row
+                    self._remember(key, row[0], row[1])
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, response):
+        created_at = time.time()
+        with self._lock:
+            self._remember(key, created_at, response)
+            if self._db is None:
+                return
+            try:
+                self._db.execute("INSERT OR REPLACE INTO responses (key, response, created_at) VALUES (?, ?, ?)",
+                                 (key, response, created_at))
+                self._disk_writes += 1
+                if self._disk_writes % 100 == 0: # Bound the on-disk store every so often
+                    self._purge_expired_from_disk()
+                    self._db.execute("DELETE FROM responses WHERE key NOT IN "
+                                     "(SELECT key FROM responses ORDER BY created_at DESC LIMIT ?)",
+                                     (self.disk_max_entries,))
+                self._db.commit()
+            except sqlite3.Error as e:
+                logging.error(f"Response cache write failed: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "persistent": self._db is not None
+            }
+
+
+response_cache = ResponseCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS, CACHE_DB_PATH) if CACHE_ENABLED else None
+
+
+# -----------------------------------------------------------------------------
+# Multi-Backend LLM Router
+# -----------------------------------------------------------------------------
+_PROOF_TASK_RE = re.compile(r"\b(prove|proof|show\s+that|derive|derivation|theorem|lemma|step[\s-]+by[\s-]+step|"
+                            r"explain\s+why|justify)\b", re.IGNORECASE)
+
+
+def classify_task(conversation_history):
+    # "proof" for long or proof-style requests, "chat" for short questions and arithmetic.
+    user_input = next((message.get("content", "") for message in reversed(conversation_history)
+                       if message.get("role") == "user"), "")
+    if len(user_input) > ROUTER_LONG_PROMPT_CHARS or _PROOF_TASK_RE.search(user_input):
+        return "proof"
+    return "chat"
+
+
+class LLMBackend:
+    # One model server behind the router, with its own pooled LLMClient and circuit breaker.
+    def __init__(self, name, client, weight=1.0, tasks=("*",), health_url=None):
+        self.name = name
+        self.client = client
+        self.weight = max(weight, 0.01)
+        self.tasks = set(tasks)
+        self.health_url = health_url or re.sub(r"/chat/completions/?$", "/models", client.endpoint)
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0 # Circuit is open (backend skipped) until this time
+        self.healthy = True
+        self.requests = 0
+        self.failures = 0
+
+    def serves(self, task_type):
+        return "*" in self.tasks or task_type in self.tasks
+
+    def available(self):
+        return self.healthy and time.monotonic() >= self.open_until
+
+    def stats(self):
+        return {"model": self.client.model_name, "endpoint": self.client.endpoint, "outstanding": self.outstanding,
+                "requests": self.requests, "failures": self.failures, "healthy": self.healthy,
+                "circuit_open": time.monotonic() < self.open_until, "tasks": sorted(self.tasks)}
+
+
+# Reported to LLMRouter._finish when a backend client raised instead of returning.
+_BACKEND_RAISED = LLMError("Error: LLM backend call raised an exception.")
+
+
+class LLMRouter:
+    # Drop-in replacement for LLMClient that spreads requests over several backends.
+    # Backends are picked per task type by least outstanding requests (per unit of weight)
+    # or weighted random choice. A backend that fails failure_threshold times in a row has
+    # its circuit opened for cooldown_seconds, and a failed request is retried on the next
+    # candidate straight away. A background thread polls each backend's /v1/models route.
+    def __init__(self, backends, strategy="least_outstanding", failure_threshold=3, cooldown_seconds=30.0,
+                 health_check_interval=15.0):
+        self.backends = backends
+        self.strategy = strategy
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.health_check_interval = health_check_interval
+        self.endpoint = backends[0].client.endpoint
+        self.model_name = backends[0].client.model_name
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        if health_check_interval > 0:
+            threading.Thread(target=self._health_check_loop, daemon=True, name="llm-health").start()
+
+    def _candidates(self, task_type):
+        with self._lock:
+            matching = [backend for backend in self.backends if backend.serves(task_type)] or list(self.backends)
+            available = [backend for backend in matching if backend.available()]
+            if not available: # Everything is tripped; try the backend whose cooldown ends first
+                return sorted(matching, key=lambda backend: backend.open_until)[:1]
+            if self.strategy == "weighted":
+                first = random.choices(available, weights=[backend.weight for backend in available])[0]
+                return [first] + sorted((b for b in available if b is not first), key=lambda b: -b.weight)
+            # Ties (e.g. an idle pool) go to the backend that has served the fewest requests.
+            return sorted(available, key=lambda backend: ((backend.outstanding + 1) / backend.weight,
+                                                          backend.requests / backend.weight))
+
+    def _begin(self, backend):
+        with self._lock:
+            backend.outstanding += 1
+            backend.requests += 1
+
+    def _finish(self, backend, error=None):
+        # error is the LLMError the client reported (None on success). Only backend faults
+        # count towards the circuit breaker; a local "busy" error just moves on to the next
+        # candidate.
+        with self._lock:
+            backend.outstanding -= 1
+            if error is None:
+                backend.consecutive_failures = 0
+                backend.open_until = 0.0
+                return
+            if not error.backend_fault:
+                return
+            backend.failures += 1
+            backend.consecutive_failures += 1
+            if backend.consecutive_failures >= self.failure_threshold:
+                backend.open_until = time.monotonic() + self.cooldown_seconds
+                logging.warning(f"LLM router: circuit opened for backend '{backend.name}' for {self.cooldown_seconds}s.")
+
+    def complete(self, conversation_history, temperature, max_tokens, task_type=None):
+        task_type = task_type or classify_task(conversation_history)
+        llm_response = LLMError("Error: No LLM backend available.")
+        for backend in self._candidates(task_type):
+            self._begin(backend)
+            error = _BACKEND_RAISED # Replaced once the client returns
+            try:
+                llm_response = backend.client.complete(conversation_history, temperature, max_tokens)
+                error = llm_response if isinstance(llm_response, LLMError) else None
+            finally:
+                self._finish(backend, error)
+            if error is None:
+                logging.debug(f"LLM router: '{task_type}' request served by backend '{backend.name}'.")
+                return llm_response
+            logging.warning(f"LLM router: backend '{backend.name}' failed ({llm_response[:120]}); failing over.")
+        return llm_response
+
+    def stream(self, conversation_history, temperature, max_tokens, task_type=None):
+        # Fails over only before the first token; once text has reached the caller the
+        # stream is committed to that backend.
+        task_type = task_type or classify_task(conversation_history)
+        last_error = LLMError("Error: No LLM backend available.")
+        for backend in self._candidates(task_type):
+            self._begin(backend)
+            deltas = backend.client.stream(conversation_history, temperature, max_tokens)
+            error = _BACKEND_RAISED # Replaced once the client yields or ends
+            try:
+                first_delta = next(deltas, None)
+                if isinstance(first_delta, LLMError):
+                    error = last_error = first_delta
+                    logging.warning(f"LLM router: backend '{backend.name}' failed ({first_delta[:120]}); failing over.")
+                    continue
+                error = None
+                if first_delta is None: # The model produced no text; that is not a backend fault
+                    return
+                yield first_delta
+                for delta in deltas:
+                    if isinstance(delta, LLMError):
+                        error = delta # Broke off mid-answer; too late to fail over
+                    yield delta
+                return
+            finally:
+                deltas.close()
+                self._finish(backend, error)
+        yield last_error
+
+    def _probe_backend(self, backend):
+        response = backend.client.session.get(backend.health_url, timeout=(backend.client.timeout[0], 5))
+        return response.status_code < 500
+
+    def _check_backend_health(self, backend):
+        try:
+            healthy = self._probe_backend(backend)
+        except requests.exceptions.RequestException:
+            healthy = False
+        with self._lock:
+            if healthy != backend.healthy:
+                logging.warning(f"LLM router: backend '{backend.name}' is now {'healthy' if healthy else 'unhealthy'}.")
+            backend.healthy = healthy
+
+    def _health_check_loop(self):
+        while not self._closed.wait(self.health_check_interval):
+            for backend in self.backends:
+                self._check_backend_health(backend)
+
+    def stats(self):
+        with self._lock:
+            return {backend.name: backend.stats() for backend in self.backends}
+
+    def close(self):
+        self._closed.set()
+        for backend in self.backends:
+            backend.client.close()
+
+
+def _configured_backends(client_class, default_max_in_flight):
+    # One LLMBackend per [BACKEND:<name>] section, with a client_class (LLMClient or
+    # AsyncLLMClient) instance each. Returns [] when no backend sections are configured.
+    backends = []
+    for section in config.sections():
+        if not section.upper().startswith("BACKEND:"):
+            continue
+        max_in_flight = config.getint(section, 'max_in_flight', fallback=default_max_in_flight)
+        client = client_class(config.get(section, 'endpoint'), config.get(section, 'model_name', fallback=MODEL_NAME),
+                              config.get(section, 'api_key', fallback=API_KEY),
+                              max_in_flight=max_in_flight, pool_size=max_in_flight,
+                              connect_timeout=config.getfloat(section, 'connect_timeout', fallback=LLM_CONNECT_TIMEOUT),
+                              read_timeout=config.getfloat(section, 'read_timeout', fallback=LLM_READ_TIMEOUT),
+                              queue_timeout=LLM_QUEUE_TIMEOUT)
+        tasks = [task.strip() for task in config.get(section, 'tasks', fallback='*').split(',') if task.strip()]
+        backends.append(LLMBackend(section.split(":", 1)[1].strip(), client,
+                                   weight=config.getfloat(section, 'weight', fallback=1.0), tasks=tasks or ["*"],
+                                   health_url=config.get(section, 'health_url', fallback=None)))
+    if backends:
+        logging.info(f"LLM router configured with backends: {', '.join(backend.name for backend in backends)}")
+    return backends
+
+
+def _create_llm_client():
+    # [BACKEND:<name>] sections configure a routed pool of model servers; without any,
+    # the single [LLM] endpoint is used directly.
+    backends = _configured_backends(LLMClient, LLM_MAX_IN_FLIGHT)
+    if not backends:
+        return LLMClient(LLM_ENDPOINT, MODEL_NAME, API_KEY,
+                         max_in_flight=LLM_MAX_IN_FLIGHT, pool_size=LLM_POOL_SIZE,
+                         connect_timeout=LLM_CONNECT_TIMEOUT, read_timeout=LLM_READ_TIMEOUT,
+                         queue_timeout=LLM_QUEUE_TIMEOUT)
+    return LLMRouter(backends, strategy=ROUTER_STRATEGY, failure_threshold=ROUTER_FAILURE_THRESHOLD,
+                     cooldown_seconds=ROUTER_COOLDOWN_SECONDS, health_check_interval=ROUTER_HEALTH_CHECK_INTERVAL)
+
+
+llm_client = _create_llm_client()
+
+
+# -----------------------------------------------------------------------------
+# Request Coalescing (single-flight)
+# -----------------------------------------------------------------------------
+class _InFlightCall:
+    __slots__ = ("condition", "chunks", "result", "error", "done")
+
+    def __init__(self, condition):
+        self.condition = condition
+        self.chunks = [] # Streamed deltas so far, replayed to every subscriber
+        self.result = None
+        self.error = None
+        self.done = False
+
+
+class SingleFlight:
+    # Lets concurrent identical LLM requests share one upstream call. The first caller for a
+    # key (the leader) does the work and callers arriving while it is in flight receive the
+    # same result. Streams are pumped by a background thread into a shared buffer that each
+    # subscriber replays from the start, so late joiners still get the whole answer and a
+    # disconnecting client does not cut the stream short for the others.
+    def __init__(self):
+        self.leaders = 0
+        self.coalesced = 0
+        self._calls = {} # key -> _InFlightCall
+        self._lock = threading.Lock()
+
+    def _join(self, key):
+        # Returns (call, is_leader).
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                return call, False
+            call = _InFlightCall(threading.Condition())
+            self._calls[key] = call
+            self.leaders += 1
+            return call, True
+
+    def _finish(self, key, call, result=None, error=None):
+        with self._lock:
+            self._calls.pop(key, None)
+        with call.condition:
+            call.result, call.error, call.done = result, error, True
+            call.condition.notify_all()
+
+    def do(self, key, fn):
+        key = ("complete", key)
+        call, is_leader = self._join(key)
+        if is_leader:
+            try:
+                result = fn()
+            except Exception as e:
+                self._finish(key, call, error=e)
+                raise
+            self._finish(key, call, result=result)
+            return result
+        with call.condition:
+            call.condition.wait_for(lambda: call.done)
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stream(self, key, make_iterator):
+        key = ("stream", key)
+        call, is_leader = self._join(key)
+        if is_leader:
+            threading.Thread(target=self._pump, args=(key, call, make_iterator), daemon=True,
+                             name="LLMStreamPump").start()
+        index = 0
+        while True:
+            with call.condition:
+                call.condition.wait_for(lambda: len(call.chunks) > index or call.done)
+                pending, done = call.chunks[index:], call.done
+            index += len(pending)
+            yield from pending
+            if done: # No chunks are added after done is set, so pending was the tail
+                if call.error is not None:
+                    raise call.error
+                return
+
+    def _pump(self, key, call, make_iterator):
+        error = None
+        try:
+            for delta in make_iterator():
+                with call.condition:
+                    call.chunks.append(delta)
+                    call.condition.notify_all()
+        except Exception as e:
+            logging.error(f"Shared LLM stream failed: {e}", exc_info=True)
+            error = e
+        self._finish(key, call, error=error)
+
+    def stats(self):
+        with self._lock:
+            return {"leaders": self.leaders, "coalesced": self.coalesced, "in_flight": len(self._calls)}
+
+
+class AsyncSingleFlight:
+    # Event-loop counterpart of SingleFlight for the aiohttp server. Everything runs on one
+    # loop, so no lock is needed; shared work runs in its own task and waiters are shielded
+    # so a client that disconnects does not cancel the call for everyone else.
+    def __init__(self):
+        self.leaders = 0
+        self.coalesced = 0
+        self._calls = {} # key -> asyncio.Task (complete) or _InFlightCall (stream)
+        self._pumps = set() # Strong references so running pump tasks are not garbage collected
+
+    async def do(self, key, make_coroutine):
+        key = ("complete", key)
+        task = self._calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.leaders += 1
+            task = asyncio.ensure_future(make_coroutine())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def stream(self, key, make_async_iterator):
+        key = ("stream", key)
+        call = self._calls.get(key)
+        if call is not None:
+            self.coalesced += 1
+        else:
+            self.leaders += 1
+            call = _InFlightCall(asyncio.Condition())
+            self._calls[key] = call
+            pump = asyncio.ensure_future(self._pump(key, call, make_async_iterator))
+            self._pumps.add(pump)
+            pump.add_done_callback(self._pumps.discard)
+        index = 0
+        while True:
+            async with call.condition:
+                await call.condition.wait_for(lambda: len(call.chunks) > index or call.done)
+                pending, done = call.chunks[index:], call.done
+            index += len(pending)
+            for delta in pending:
+                yield delta
+            if done:
+                if call.error is not None:
+                    raise call.error
+                return
+
+    async def _pump(self, key, call, make_async_iterator):
+        try:
+            async for delta in make_async_iterator():
+                async with call.condition:
+                    call.chunks.append(delta)
+                    call.condition.notify_all()
+        except Exception as e:
+            logging.error(f"Shared LLM stream failed (async): {e}", exc_info=True)
+            call.error = e
+        finally:
+            self._calls.pop(key, None)
+            async with call.condition:
+                call.done = True
+                call.condition.notify_all()
+
+    def stats(self):
+        return {"leaders": self.leaders, "coalesced": self.coalesced, "in_flight": len(self._calls)}
+
+
+single_flight = SingleFlight() if LLM_COALESCE else None
+async_single_flight = AsyncSingleFlight() if LLM_COALESCE else None
+
+
+def coalescing_stats():
+    stats = {"enabled": single_flight is not None}
+    if single_flight is not None:
+        threaded, event_loop = single_flight.stats(), async_single_flight.stats()
+        stats.update({name: threaded[name] + event_loop[name] for name in threaded})
+    return stats
+
+
+# -----------------------------------------------------------------------------
+# Micro-Batching Request Scheduler
+# -----------------------------------------------------------------------------
+PRIORITY_INTERACTIVE = 0 # GUI turns
+PRIORITY_DEFAULT = 1 # HTTP requests
+PRIORITY_BATCH = 2 # Batch jobs and background summaries
+_PRIORITY_LANES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_DEFAULT: "default", PRIORITY_BATCH: "batch"}
+_STREAM_END = object()
+
+
+class _ScheduledJob:
+    __slots__ = ("fn", "priority", "enqueued_at", "deltas", "dispatched", "done", "result", "error", "cancelled")
+
+    def __init__(self, fn, priority, streaming):
+        self.fn = fn
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.deltas = queue.Queue() if streaming else None
+        self.dispatched = threading.Event()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.cancelled = False
+
+
+class MicroBatchScheduler:
+    # Sits between the front-door functions and llm_client. Requests are queued by priority
+    # lane; once a worker is free the dispatcher holds the window open for window_ms (or until
+    # max_batch_size requests are waiting) and then releases the highest-priority ones together
+    # as a parallel burst of at most max_parallel upstream calls. OpenAI-compatible servers
+    # (LM Studio, vLLM, llama.cpp) batch concurrent requests on their side, so arriving together
+    # is what lets them share decode steps. Jobs stay in the heap until a worker is actually
+    # free, so a GUI turn submitted later still overtakes queued batch work. A caller whose job
+    # has not been dispatched within queue_timeout withdraws it and gets the "busy" error, even
+    # while every worker is still tied up in a long generation.
+    def __init__(self, window_ms=10, max_batch_size=8, max_parallel=4, queue_timeout=60.0):
+        self.window_seconds = max(0.0, window_ms) / 1000
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_parallel = max(1, max_parallel)
+        self.queue_timeout = queue_timeout
+        self.submitted = 0
+        self.bursts = 0
+        self.dispatched = 0
+        self.expired = 0
+        self._heap = [] # (priority, sequence, job)
+        self._sequence = 0
+        self._idle_workers = self.max_parallel
+        self._closed = False
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_parallel, thread_name_prefix="LLMWorker")
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, daemon=True, name="LLMScheduler")
+        self._dispatcher.start()
+
+    def _enqueue(self, fn, priority, streaming):
+        job = _ScheduledJob(fn, priority, streaming)
+        with self._condition:
+            heapq.heappush(self._heap, (priority, self._sequence, job))
+            self._sequence += 1
+            self.submitted += 1
+            self._condition.notify_all()
+        return job
+
+    def submit(self, fn, priority=PRIORITY_DEFAULT):
+        # Runs fn() on a worker and returns its result once scheduled and finished.
+        job = self._enqueue(fn, priority, streaming=False)
+        if not self._await_dispatch(job):
+            return LLMError("Error: LLM server is busy. Please try again shortly.", backend_fault=False)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def submit_stream(self, make_iterator, priority=PRIORITY_DEFAULT):
+        # Iterates make_iterator() on a worker and yields its items as they arrive.
+        job = self._enqueue(make_iterator, priority, streaming=True)
+        if not self._await_dispatch(job):
+            yield LLMError("Error: LLM server is busy. Please try again shortly.", backend_fault=False)
+            return
+        try:
+            while True:
+                delta = job.deltas.get()
+                if delta is _STREAM_END:
+                    break
+                yield delta
+        finally:
+            job.cancelled = True # Lets the worker stop early if the consumer went away
+        if job.error is not None:
+            raise job.error
+
+    def _await_dispatch(self, job):
+        # Returns False, after taking the job out of the queue, if no worker picked it up in time.
+        if not self.queue_timeout or job.dispatched.wait(self.queue_timeout):
+            return True
+        with self._condition:
+            if job.dispatched.is_set(): # Dispatched just as the wait timed out
+                return True
+            self._heap = [entry for entry in self._heap if entry[2] is not job]
+            heapq.heapify(self._heap)
+            self.expired += 1
+        logging.error(f"LLM scheduler: request waited more than {self.queue_timeout}s for a worker.")
+        return False
+
+    def _dispatch_loop(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._closed or (self._heap and self._idle_workers))
+                if self._closed:
+                    return
+                deadline = time.monotonic() + self.window_seconds
+                while len(self._heap) < self.max_batch_size and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                burst = []
+                while self._heap and len(burst) < min(self._idle_workers, self.max_batch_size):
+                    _, _, job = heapq.heappop(self._heap)
+                    job.dispatched.set()
+                    burst.append(job)
+                self._idle_workers -= len(burst)
+                if burst:
+                    self.bursts += 1
+                    self.dispatched += len(burst)
+            for job in burst:
+                self._executor.submit(self._run, job)
+
+    def _run(self, job):
+        record_stage("queue_wait", time.monotonic() - job.enqueued_at, lane=_PRIORITY_LANES.get(job.priority, job.priority))
+        result, error = None, None
+        try:
+            if job.deltas is None:
+                result = job.fn()
+            else:
+                iterator = job.fn()
+                try:
+                    for delta in iterator:
+                        if job.cancelled:
+                            break
+                        job.deltas.put(delta)
+                finally:
+                    if hasattr(iterator, "close"):
+                        iterator.close() # Releases the upstream connection if we stopped early
+        except Exception as e:
+            logging.error(f"LLM scheduler job failed: {e}", exc_info=True)
+            error = e
+        self._complete(job, result, error)
+        with self._condition:
+            self._idle_workers += 1
+            self._condition.notify_all()
+
+    def _complete(self, job, result=None, error=None):
+        if job.deltas is not None:
+            if result is not None:
+                job.deltas.put(result)
+            job.deltas.put(_STREAM_END)
+        job.result, job.error = result, error
+        job.done.set()
+
+    def stats(self):
+        with self._condition:
+            queued = {lane: 0 for lane in _PRIORITY_LANES.values()}
+            for priority, _, _ in self._heap:
+                queued[_PRIORITY_LANES.get(priority, str(priority))] += 1
+            return {
+                "queued": queued,
+                "in_flight": self.max_parallel - self._idle_workers,
+                "submitted": self.submitted,
+                "bursts": self.bursts,
+                "mean_burst_size": round(self.dispatched / self.bursts, 2) if self.bursts else 0.0,
+                "expired": self.expired,
+                "window_ms": self.window_seconds * 1000,
+                "max_parallel": self.max_parallel
+            }
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._executor.shutdown(wait=False)
+
+
+request_scheduler = MicroBatchScheduler(SCHEDULER_WINDOW_MS, SCHEDULER_MAX_BATCH_SIZE, SCHEDULER_MAX_PARALLEL,
+                                        LLM_QUEUE_TIMEOUT) if SCHEDULER_ENABLED else None
+
+
+# -----------------------------------------------------------------------------
+# LLM Interaction Functions
+# -----------------------------------------------------------------------------
+def _flight_key(conversation_history, temperature, max_tokens, priority=PRIORITY_DEFAULT):
+    # Requests are coalesced on the same normalized key the response cache uses, per scheduler
+    # lane: an interactive turn must not wait behind an identical batch request's queued leader.
+    return priority, make_cache_key(MODEL_NAME, conversation_history, temperature, max_tokens)
+
+
+def _cache_lookup(conversation_history, temperature, max_tokens, use_cache):
+    # Returns (cache_key, cached_response); cache_key is None when caching is bypassed.
+    if not use_cache or response_cache is None:
+        return None, None
+    with timed_stage("cache_lookup"):
+        cache_key = make_cache_key(MODEL_NAME, conversation_history, temperature, max_tokens)
+        return cache_key, response_cache.get(cache_key)
+
+
+def _cache_store(cache_key, llm_response):
+    if cache_key is not None and not _is_llm_error(llm_response):
+        response_cache.set(cache_key, llm_response)
+
+
+def get_llm_response(conversation_history, temperature, max_tokens, use_cache=True, priority=PRIORITY_DEFAULT):
+    cache_key, cached_response = _cache_lookup(conversation_history, temperature, max_tokens, use_cache)
+    if cached_response is not None:
+        logging.debug("LLM response served from cache.")
+        return cached_response
+
+    def complete_and_cache():
+        if request_scheduler is None:
+            llm_response = llm_client.complete(conversation_history, temperature, max_tokens)
+        else:
+            llm_response = request_scheduler.submit(
+                lambda: llm_client.complete(conversation_history, temperature, max_tokens), priority)
+        _cache_store(cache_key, llm_response)
+        return llm_response
+
+    if single_flight is None:
+        return complete_and_cache()
+    return single_flight.do(_flight_key(conversation_history, temperature, max_tokens, priority), complete_and_cache)
+
+
+def stream_llm_response(conversation_history, temperature, max_tokens, use_cache=True, priority=PRIORITY_DEFAULT):
+    cache_key, cached_response = _cache_lookup(conversation_history, temperature, max_tokens, use_cache)
+    if cached_response is not None:
+        logging.debug("LLM streamed response served from cache.")
+        yield cached_response
+        return
+
+    def stream_and_cache():
+        if request_scheduler is None:
+            deltas = llm_client.stream(conversation_history, temperature, max_tokens)
+        else:
+            deltas = request_scheduler.submit_stream(
+                lambda: llm_client.stream(conversation_history, temperature, max_tokens), priority)
+        chunks = []
+        for delta in deltas:
+            chunks.append(delta)
+            yield delta
+        _cache_store(cache_key, _join_stream(chunks)) # Skipped by _cache_store if the stream broke off
+
+    if single_flight is None:
+        yield from stream_and_cache()
+    else:
+        yield from single_flight.stream(_flight_key(conversation_history, temperature, max_tokens, priority),
+                                        stream_and_cache)
+
+
+# -----------------------------------------------------------------------------
+# Local Math Fast-Path
+# -----------------------------------------------------------------------------
+_ARITHMETIC_BINARY_OPS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod, ast.Pow: operator.pow
+}
+_ARITHMETIC_UNARY_OPS = {ast.UAdd: operator.pos, ast.USub: operator.neg}
+_ARITHMETIC_FUNCTIONS = {
+    "sqrt": math.sqrt, "sin": math.sin, "cos": math.cos, "tan": math.tan, "exp": math.exp,
+    "log": math.log, "ln": math.log, "log10": math.log10, "abs": abs
+}
+_ARITHMETIC_CONSTANTS = {"pi": math.pi, "e": math.e}
+_DATE_LIKE_RE = re.compile(r"^\d{1,4}-\d{1,2}-\d{1,4}$") # 2023-10-17 or 17-10-2023 is a date, not a subtraction
+# Names the SymPy parser may see; any other multi-letter word sends the input to the LLM.
+_SYMPY_ALLOWED_WORDS = {"sqrt", "sin", "cos", "tan", "asin", "acos", "atan", "sinh", "cosh", "tanh",
+                        "exp", "log", "ln", "abs", "pi", "e", "oo"}
+_MAX_EXPONENT = 1000
+
+_MATH_PREFIX_RE = re.compile(r"^(?:please\s+)?(?:what\s+is|what's|whats|calculate|compute|evaluate)\s+", re.IGNORECASE)
+_DERIVATIVE_RE = re.compile(r"^(?:find\s+)?(?:the\s+)?(?:derivative\s+of|differentiate|d/d([a-z]))\s+(.+?)"
+                            r"(?:\s+(?:with\s+respect\s+to|wrt)\s+([a-z]))?$", re.IGNORECASE)
+_INTEGRAL_RE = re.compile(r"^(?:find\s+)?(?:the\s+)?(?:integral\s+of|integrate|antiderivative\s+of)\s+(.+?)"
+                          r"(?:\s*d([a-z]))?$", re.IGNORECASE)
+_SOLVE_RE = re.compile(r"^(?:solve\s+)?(.+?)(?:\s+for\s+([a-z]))?$", re.IGNORECASE)
+_REWRITE_RE = re.compile(r"^(simplify|expand|factor)\s+(.+)$", re.IGNORECASE)
+_SAFE_EXPRESSION_RE = re.compile(r"^[0-9a-zA-Z\s+\-*/^().,=]+$")
+# Explicit requests that stand on their own even in the middle of a conversation.
+_MATH_COMMAND_RE = re.compile(r"^\s*(?:please\s+)?(?:calculate|compute|evaluate|solve|simplify|expand|factor|differentiate|"
+                              r"integrate|d/d[a-z]\b|(?:find\s+)?(?:the\s+)?(?:derivative|integral|antiderivative)\s+of)",
+                              re.IGNORECASE)
+
+
+class LocalMathEngine:
+    # Answers simple math inputs without the LLM: plain arithmetic through a restricted
+    # AST evaluator, and derivatives, integrals, equations and simplification through
+    # SymPy when it is installed. solve() returns None for anything it cannot handle.
+    # Arithmetic is bounded and runs inline. SymPy runs in a small process pool because a
+    # stuck simplify/integrate cannot be interrupted in a thread; on timeout the pool is
+    # terminated and a fresh one is started in the background.
+    def __init__(self, timeout_seconds=2.0, max_input_length=200, workers=2):
+        self.timeout_seconds = timeout_seconds
+        self.max_input_length = max_input_length
+        self.workers = workers
+        self._pool = None
+        self._pool_ready = None # AsyncResult that completes once a worker has imported SymPy
+        self._pool_lock = threading.Lock()
+        self._sympy = None # Loaded on first use; False if unavailable
+        self._sympy_installed = None
+
+    def solve(self, user_input):
+        if not isinstance(user_input, str):
+            return None
+        text = _MATH_PREFIX_RE.sub("", user_input.strip()).strip().rstrip("?").strip()
+        text = text.replace("\u00d7", "*").replace("\u00f7", "/").replace("\u2212", "-") # Unicode times, divide, minus
+        if not text or len(text) > self.max_input_length:
+            return None
+        answer = self._solve_arithmetic(text)
+        if answer is not None or not self._is_symbolic_candidate(text) or not self._has_sympy():
+            return answer
+        pool, ready = self._get_pool()
+        if not ready.ready():
+            ready.wait(self.timeout_seconds) # Worker start-up does not count against the solve timeout
+            if not ready.ready():
+                logging.info("Local math workers still starting; sending symbolic input to the LLM.")
+                return None
+        pending = pool.apply_async(_solve_symbolic_in_worker, (text,))
+        try:
+            return pending.get(timeout=self.timeout_seconds)
+        except multiprocessing.TimeoutError:
+            logging.warning(f"Local math engine timed out after {self.timeout_seconds}s on: {text}")
+            self._reset_pool(pool)
+        except Exception as e:
+            logging.debug(f"Local math engine could not handle '{text}': {e}")
+        return None
+
+    def _solve_arithmetic(self, text):
+        arithmetic_text = text.rstrip("=").strip()
+        if "=" in arithmetic_text or _DATE_LIKE_RE.match(arithmetic_text):
+            return None
+        try:
+            expression = ast.parse(arithmetic_text.replace("^", "**"), mode="eval").body
+            if not any(isinstance(node, (ast.BinOp, ast.Call)) for node in ast.walk(expression)):
+                return None # A bare number or constant ("e", "-5") is not a calculation
+            value = self._eval_arithmetic(expression)
+            return f"{arithmetic_text} = {self._format_number(value)}"
+        except (SyntaxError, ValueError, TypeError, ZeroDivisionError, OverflowError):
+            return None # Not plain arithmetic; try the symbolic engine
+
+    def _is_symbolic_candidate(self, text):
+        # Mirrors the dispatch in _solve_symbolic so ordinary questions never reach the worker pool.
+        if _DERIVATIVE_RE.match(text) or _INTEGRAL_RE.match(text) or _REWRITE_RE.match(text):
+            return True
+        match = _SOLVE_RE.match(text)
+        return bool(match) and (self._is_bare_equation(match.group(1)) or text.lower().startswith("solve"))
+
+    def _is_bare_equation(self, text):
+        return "=" in text and re.search(r"\d", text) is not None
+
+    def _has_sympy(self):
+        if self._sympy_installed is None:
+            self._sympy_installed = importlib.util.find_spec("sympy") is not None
+            if not self._sympy_installed:
+                logging.info("SymPy not installed; local math fast-path limited to arithmetic.")
+        return self._sympy_installed
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._start_pool()
+            return self._pool, self._pool_ready
+
+    def _start_pool(self):
+        # spawn rather than fork: the parent runs logging and scheduler threads whose locks
+        # a forked child could inherit in a held state.
+        context = multiprocessing.get_context("spawn")
+        self._pool = context.Pool(processes=self.workers, initializer=_init_math_worker)
+        self._pool_ready = self._pool.apply_async(_solve_symbolic_in_worker, ("x",))
+
+    def _reset_pool(self, pool):
+        with self._pool_lock:
+            if self._pool is pool:
+                self._start_pool()
+        pool.terminate() # Kills the stuck SymPy call; other callers on this pool fall back to the LLM
+
+    def close(self):
+        with self._pool_lock:
+            pool, self._pool, self._pool_ready = self._pool, None, None
+        if pool is not None:
+            pool.terminate()
+
+    def _eval_arithmetic(self, node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            return node.value
+        if isinstance(node, ast.BinOp) and type(node.op) in _ARITHMETIC_BINARY_OPS:
+            left = self._eval_arithmetic(node.left)
+            right = self._eval_arithmetic(node.right)
+            if isinstance(node.op, ast.Pow) and (abs(right) > _MAX_EXPONENT or
+                                                 abs(left) > 1 and math.log2(abs(left)) * abs(right) > 100000):
+                raise ValueError("exponent too large")
+            return _ARITHMETIC_BINARY_OPS[type(node.op)](left, right)
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _ARITHMETIC_UNARY_OPS:
+            return _ARITHMETIC_UNARY_OPS[type(node.op)](self._eval_arithmetic(node.operand))
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _ARITHMETIC_FUNCTIONS
+                and len(node.args) == 1 and not node.keywords):
+            return _ARITHMETIC_FUNCTIONS[node.func.id](self._eval_arithmetic(node.args[0]))
+        if isinstance(node, ast.Name) and node.id in _ARITHMETIC_CONSTANTS:
+            return _ARITHMETIC_CONSTANTS[node.id]
+        raise ValueError("unsupported arithmetic expression")
+
+    def _format_number(self, value):
+        if isinstance(value, float):
+            if value.is_integer() and abs(value) < 1e15:
+                return str(int(value))
+            return f"{value:.12g}"
+        return str(value)
+
+    def _load_sympy(self):
+        if self._sympy is None:
+            try:
+                import sympy
+                from sympy.parsing import sympy_parser
+                self._sympy = (sympy, sympy_parser)
+            except ImportError:
+                logging.info("SymPy not installed; local math fast-path limited to arithmetic.")
+                self._sympy = False
+        return self._sympy
+
+    def _parse(self, expression_text):
+        sympy, sympy_parser = self._sympy
+        if not _SAFE_EXPRESSION_RE.match(expression_text) or re.search(r"\.\s*[a-zA-Z]", expression_text):
+            raise ValueError("expression contains unsupported characters")
+        for word in re.findall(r"[a-zA-Z]+", expression_text):
+            if len(word) > 1 and word.lower() not in _SYMPY_ALLOWED_WORDS:
+                raise ValueError(f"unsupported word '{word}'")
+        # parse_expr evaluates generated code, so it only gets a minimal namespace without builtins.
+        global_dict = {"__builtins__": {}, "Integer": sympy.Integer, "Float": sympy.Float, "Rational": sympy.Rational,
+                       "Symbol": sympy.Symbol, "Function": sympy.Function, "Add": sympy.Add, "Mul": sympy.Mul,
+                       "Pow": sympy.Pow, "ln": sympy.log, "oo": sympy.oo}
+        for name in _SYMPY_ALLOWED_WORDS - {"ln", "oo"}:
+            global_dict[name] = getattr(sympy, "Abs" if name == "abs" else "E" if name == "e" else name)
+        transformations = sympy_parser.standard_transformations + (
+            sympy_parser.implicit_multiplication_application, sympy_parser.convert_xor)
+        expression = sympy_parser.parse_expr(expression_text, local_dict={}, global_dict=global_dict,
+                                             transformations=transformations, evaluate=False)
+        for power in expression.atoms(sympy.Pow):
+            if power.exp.free_symbols:
+                continue
+            if abs(complex(power.exp.evalf(15))) > _MAX_EXPONENT:
+                raise ValueError("exponent too large")
+        return expression.doit() # Safe to evaluate once exponents are bounded
+
+    def _pick_variable(self, expression, preferred=None):
+        sympy = self._sympy[0]
+        if preferred:
+            return sympy.Symbol(preferred)
+        free_symbols = sorted(expression.free_symbols, key=lambda symbol: symbol.name)
+        if not free_symbols:
+            return sympy.Symbol("x")
+        for symbol in free_symbols:
+            if symbol.name == "x":
+                return symbol
+        return free_symbols[0]
+
+    def _solve_symbolic(self, text):
+        if not self._load_sympy():
+            return None
+        sympy = self._sympy[0]
+
+        match = _DERIVATIVE_RE.match(text)
+        if match:
+            expression = self._parse(match.group(2))
+            variable = self._pick_variable(expression, match.group(1) or match.group(3))
+            result = sympy.simplify(sympy.diff(expression, variable))
+            return f"d/d{variable} [{sympy.sstr(expression)}] = {sympy.sstr(result)}"
+
+        match = _INTEGRAL_RE.match(text)
+        if match:
+            expression = self._parse(match.group(1))
+            variable = self._pick_variable(expression, match.group(2))
+            result = sympy.integrate(expression, variable)
+            if result.has(sympy.Integral):
+                return None # SymPy could not find a closed form
+            return f"Integral of {sympy.sstr(expression)} d{variable} = {sympy.sstr(result)} + C"
+
+        match = _REWRITE_RE.match(text)
+        if match:
+            action = match.group(1).lower()
+            expression = self._parse(match.group(2))
+            result = getattr(sympy, action)(expression)
+            return f"{action.capitalize()}: {sympy.sstr(expression)} = {sympy.sstr(result)}"
+
+        match = _SOLVE_RE.match(text)
+        if match and (self._is_bare_equation(match.group(1)) or text.lower().startswith("solve")):
+            sides = match.group(1).split("=")
+            if len(sides) > 2 or not all(side.strip() for side in sides):
+                return None
+            left = self._parse(sides[0])
+            right = self._parse(sides[1]) if len(sides) == 2 else sympy.Integer(0)
+            equation = sympy.Eq(left, right)
+            if not equation.free_symbols:
+                return None
+            variable = self._pick_variable(equation, match.group(2))
+            solutions = sympy.solve(equation, variable)
+            if not solutions:
+                return f"No solution for {variable} in {sympy.sstr(left)} = {sympy.sstr(right)}."
+            solved = ", ".join(f"{variable} = {sympy.sstr(solution)}" for solution in solutions)
+            return f"Solving {sympy.sstr(left)} = {sympy.sstr(right)} for {variable}: {solved}"
+        return None
+
+
+# Worker-process side of LocalMathEngine; each pool process keeps its own engine with SymPy loaded.
+_worker_math_engine = None
+
+
+def _init_math_worker():
+    global _worker_math_engine
+    _worker_math_engine = LocalMathEngine()
+    _worker_math_engine._load_sympy()
+
+
+def _solve_symbolic_in_worker(text):
+    return _worker_math_engine._solve_symbolic(text)
+
+
+local_math_engine = LocalMathEngine(MATH_TIMEOUT_SECONDS, MATH_MAX_INPUT_LENGTH) if MATH_FAST_PATH_ENABLED else None
+if local_math_engine:
+    atexit.register(local_math_engine.close)
+
+
+# -----------------------------------------------------------------------------
+# Semantic Answer Reuse (local embeddings + vector index)
+# -----------------------------------------------------------------------------
+# Applied before embedding so that common rewordings of the same maths question
+# ("what's the derivative of x squared" / "differentiate x^2") end up close together.
+_SEMANTIC_REWRITES = (
+    (re.compile(r"\*\*"), "^"),
+    (re.compile(r"\bsquared\b"), "^2"),
+    (re.compile(r"\bcubed\b"), "^3"),
+    (re.compile(r"\bto the power of\b"), "^"),
+    (re.compile(r"\b(differentiate|derive|d/dx)\b"), "derivative"),
+    (re.compile(r"\b(integrate|antiderivative)\b"), "integral"),
+    # Single letters are never dropped here: "a" may be a variable ("derivative of a x^2").
+    (re.compile(r"\b(what's|whats|what is|find|compute|calculate|work out|please|can you|could you|"
+                r"tell me|the|of|an|for|me)\b"), " "),
+    (re.compile(r"[?!.,:;]"), " "),
+    (re.compile(r"\s*([\^*/+\-=()])\s*"), r"\1"),
+    (re.compile(r"\s+"), " "),
+)
+_MATH_TOKEN_RE = re.compile(r"\d+(?:\.\d+)?|\b[a-z]\b|[\^*/+\-=()]")
+_SEMANTIC_CANDIDATES = 4
+
+
+def _normalize_question(text):
+    text = text.lower()
+    for pattern, replacement in _SEMANTIC_REWRITES:
+        text = pattern.sub(replacement, text)
+    return text.strip()
+
+
+def _system_prompt_key(conversation_history):
+    # Answers are only reused under the system prompt they were written for (GUI persona, HTTP,
+    # batch, or a per-item override), since the prompt shapes the answer as much as the question.
+    first = conversation_history[0] if conversation_history else {}
+    prompt = first.get("content", "") if first.get("role") == "system" else ""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+
+def _math_signature(normalized_text):
+    # Numbers, single-letter variables and operators in order. A stored answer is only reused
+    # when these match exactly, so "x^2" never borrows the answer to "x^3".
+    return tuple(_MATH_TOKEN_RE.findall(normalized_text))
+
+
+class HashingEmbedder:
+    # Dependency-free CPU embedder: word unigrams/bigrams and character trigrams hashed into
+    # signed buckets (feature hashing), then L2-normalised. It matches rewordings that share
+    # vocabulary after _normalize_question; a sentence-transformers model also catches synonyms.
+    # Similarity here only reflects shared spelling, so "sqrt 2 is irrational" and "...rational"
+    # score high; lexical embedders only reuse an answer when the normalized words match too.
+    name = "hashing"
+    lexical = True
+
+    def __init__(self, dim=512):
+        self.dim = dim
+
+    def embed(self, text):
+        import numpy as np
+        vector = np.zeros(self.dim, dtype=np.float32)
+        words = text.split()
+        padded = f" {text} "
+        features = words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+        features += [padded[i:i + 3] for i in range(len(padded) - 2)]
+        for feature in features:
+            digest = zlib.crc32(feature.encode("utf-8")) # Stable across runs, unlike hash()
+            vector[digest % self.dim] += 1.0 if digest & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class SentenceTransformerEmbedder:
+    lexical = False
+
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer # Optional dependency
+        self.name = model_name
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed(self, text):
+        return self.model.encode(text, normalize_embeddings=True).astype("float32")
+
+
+class SemanticAnswerIndex:
+    # Past standalone question/answer pairs, searched by cosine similarity of their embeddings.
+    # Vectors live in a fixed ring buffer of max_entries rows, so once it is full the oldest
+    # pair is overwritten and memory stays flat. With index_path set the buffer is a
+    # memory-mapped .npy file and the text sits in SQLite beside it, so a restart reopens the
+    # index without re-embedding anything. Search uses FAISS when installed, else one NumPy
+    # matrix-vector product. NumPy, FAISS and the embedding model are loaded on first use.
+    def __init__(self, embedding_model="hashing", threshold=0.9, max_entries=10000, index_path=None,
+                 backend="auto"):
+        self.embedding_model = embedding_model
+        self.threshold = threshold
+        self.max_entries = max(1, max_entries)
+        self.index_path = index_path
+        self.backend = backend
+        self.matches = 0
+        self.misses = 0
+        self.added = 0
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._embedder = None
+        self._vectors = None
+        self._entries = {} # slot -> (question, answer, math_signature)
+        self._next_slot = 0
+        self._faiss_index = None
+        self._db = None
+        self._writes = 0
+
+    def _ensure_loaded(self):
+        # Called with the lock held. Returns False if the index could not be set up.
+        if not self._loaded:
+            self._loaded = True
+            try:
+                self._load()
+            except Exception as e:
+                logging.error(f"Semantic answer reuse disabled: {e}")
+                self._embedder = None
+        return self._embedder is not None
+
+    def _load(self):
+        import numpy as np # Optional dependency, only needed for semantic reuse
+        self._np = np
+        if self.embedding_model == "hashing":
+            self._embedder = HashingEmbedder()
+        else:
+            self._embedder = SentenceTransformerEmbedder(self.embedding_model)
+        shape = (self.max_entries, self._embedder.dim)
+        if self.index_path:
+            self._open_persistent(shape)
+        else:
+            self._vectors = np.zeros(shape, dtype=np.float32)
+        if self.backend in ("auto", "faiss"):
+            try:
+                import faiss # Optional dependency
+                self._faiss_index = faiss.IndexIDMap2(faiss.IndexFlatIP(shape[1]))
+                if self._entries:
+                    slots = np.array(sorted(self._entries), dtype=np.int64)
+                    self._faiss_index.add_with_ids(np.ascontiguousarray(self._vectors[slots]), slots)
+            except ImportError:
+                if self.backend == "faiss":
+                    logging.warning("FAISS is not installed; the semantic index uses NumPy search instead.")
+
+    def _open_persistent(self, shape):
+        np = self._np
+        vectors_path = f"{self.index_path}.npy"
+        self._db = sqlite3.connect(f"{self.index_path}.sqlite3", check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS semantic_entries (slot INTEGER PRIMARY KEY, question TEXT NOT NULL, "
+                         "answer TEXT NOT NULL, signature TEXT NOT NULL, created_at REAL NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS semantic_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        layout = f"{self._embedder.name}:{shape[0]}x{shape[1]}"
+        row = self._db.execute("SELECT value FROM semantic_meta WHERE key = 'layout'").fetchone()
+        if row is not None and row[0] == layout and os.path.exists(vectors_path):
+            self._vectors = np.load(vectors_path, mmap_mode="r+")
+            rows = self._db.execute("SELECT slot, question, answer, signature FROM semantic_entries "
+                                    "ORDER BY created_at").fetchall()
+            for slot, question, answer, signature in rows:
+                self._entries[slot] = (question, answer, tuple(json.loads(signature)))
+            if rows:
+                self._next_slot = (rows[-1][0] + 1) % shape[0]
+        else:
+            if row is not None:
+                logging.info("Semantic index model or size changed; starting a new index.")
+            self._vectors = np.lib.format.open_memmap(vectors_path, mode="w+", dtype=np.float32, shape=shape)
+            self._db.execute("DELETE FROM semantic_entries")
+            self._db.execute("INSERT OR REPLACE INTO semantic_meta (key, value) VALUES ('layout', ?)", (layout,))
+        self._db.commit()
+        logging.info(f"Semantic index persisted to {vectors_path} ({len(self._entries)} entries).")
+
+    def _nearest(self, vector, count=1):
+        # Called with the lock held. Returns up to count (similarity, slot) pairs, closest first.
+        if self._faiss_index is not None:
+            similarities, slots = self._faiss_index.search(vector[None, :], count)
+            return [(float(similarity), int(slot)) for similarity, slot in zip(similarities[0], slots[0]) if slot >= 0]
+        scores = self._vectors @ vector
+        count = min(count, len(scores))
+        slots = self._np.argpartition(-scores, count - 1)[:count]
+        return sorted(((float(scores[slot]), int(slot)) for slot in slots), reverse=True)
+
+    def lookup(self, question, prompt_key="", require_same_question=True):
+        # Returns the closest stored pair at or above the threshold as a dict, or None. With
+        # require_same_question (answer reuse) the pair must have been stored under the same
+        # system prompt with exactly the same numbers, variables and operators, and for lexical
+        # embedders the same words; only accepted pairs count as matches.
+        with self._lock:
+            if not self._ensure_loaded():
+                return None
+        normalized = _normalize_question(question)
+        vector = self._embedder.embed(normalized) # Outside the lock; model inference can be slow
+        signature = (prompt_key,) + _math_signature(normalized)
+        with self._lock:
+            entry = None
+            if self._entries:
+                # A few neighbours are checked so a pair stored under another prompt does not hide this one.
+                for similarity, slot in self._nearest(vector, _SEMANTIC_CANDIDATES):
+                    candidate = self._entries.get(slot)
+                    if similarity < self.threshold:
+                        break
+                    if candidate is not None and (not require_same_question or
+                                                  self._same_question(candidate, normalized, signature)):
+                        entry = candidate
+                        break
+            if entry is None:
+                self.misses += 1
+                return None
+            self.matches += 1
+        stored_question, answer, _ = entry
+        return {"question": stored_question, "answer": answer, "similarity": round(similarity, 4)}
+
+    def _same_question(self, entry, normalized, signature):
+        stored_question, _, stored_signature = entry
+        if stored_signature != signature:
+            return False
+        return not self._embedder.lexical or sorted(_normalize_question(stored_question).split()) == sorted(normalized.split())
+
+    def add(self, question, answer, prompt_key=""):
+        with self._lock:
+            if not self._ensure_loaded():
+                return
+        normalized = _normalize_question(question)
+        vector = self._embedder.embed(normalized)
+        signature = (prompt_key,) + _math_signature(normalized)
+        np = self._np
+        with self._lock:
+            if self._entries:
+                similarity, slot = self._nearest(vector)[0]
+                if similarity >= 0.995 and self._entries.get(slot, (None, None, None))[2] == signature:
+                    return # Already indexed; repeats would push older questions out of the ring
+            slot = self._next_slot
+            self._next_slot = (slot + 1) % self.max_entries
+            self._vectors[slot] = vector
+            self._entries[slot] = (question, answer, signature)
+            self.added += 1
+            if self._faiss_index is not None:
+                ids = np.array([slot], dtype=np.int64)
+                self._faiss_index.remove_ids(ids) # No-op unless the slot is being overwritten
+                self._faiss_index.add_with_ids(vector[None, :], ids)
+            if self._db is None:
+                return
+            try:
+                self._db.execute("INSERT OR REPLACE INTO semantic_entries (slot, question, answer, signature, created_at) "
+                                 "VALUES (?, ?, ?, ?, ?)", (slot, question, answer, json.dumps(signature), time.time()))
+                self._db.commit()
+                self._writes += 1
+                if self._writes % 100 == 0: # The OS writes dirty pages back anyway; this bounds loss on a crash
+                    self._vectors.flush()
+            except sqlite3.Error as e:
+                logging.error(f"Semantic index write failed: {e}")
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._vectors.flush()
+                self._db.close()
+                self._db = None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.matches + self.misses
+            return {
+                "enabled": True,
+                "mode": SEMANTIC_MODE,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "matches": self.matches,
+                "misses": self.misses,
+                "match_rate": round(self.matches / lookups, 4) if lookups else 0.0,
+                "added": self.added,
+                "threshold": self.threshold,
+                "embedding_model": self.embedding_model,
+                "backend": "faiss" if self._faiss_index is not None else "numpy",
+                "persistent": self._db is not None
+            }
+
+
+semantic_index = SemanticAnswerIndex(SEMANTIC_EMBEDDING_MODEL, SEMANTIC_THRESHOLD, SEMANTIC_MAX_ENTRIES,
+                                     SEMANTIC_INDEX_PATH, SEMANTIC_INDEX_BACKEND) if SEMANTIC_ENABLED else None
+if semantic_index is not None:
+    atexit.register(semantic_index.close)
+
+
+# -----------------------------------------------------------------------------
+# Request Routing (local math fast-path, then cache/LLM)
+# -----------------------------------------------------------------------------
+_route_counts = {"local_math": 0, "semantic_cache": 0, "llm": 0}
+_route_counts_lock = threading.Lock()
+
+
+def _count_route(served_by):
+    with _route_counts_lock:
+        _route_counts[served_by] += 1
+
+
+def route_stats():
+    with _route_counts_lock:
+        return dict(_route_counts)
+
+
+def _latest_user_message(conversation_history):
+    for message in reversed(conversation_history):
+        if message.get("role") == "user":
+            return message.get("content", "")
+    return ""
+
+
+def _is_standalone_question(conversation_history):
+    # True only for the opening turn: one user message with no assistant reply or rolling summary
+    # before it. Later turns depend on the conversation so far, and a trimmed window can leave a
+    # follow-up as the only user message, so counting user messages alone is not enough.
+    user_messages = 0
+    for message in conversation_history:
+        role = message.get("role")
+        if role == "assistant" or (role == "system" and message.get("content", "").startswith(HISTORY_SUMMARY_PREFIX)):
+            return False
+        user_messages += role == "user"
+    return user_messages == 1
+
+
+def _local_math_answer(conversation_history):
+    # Bare arithmetic and equations are taken at face value only on a first turn ("2" or "x = 5"
+    # mid-conversation is usually a reply to the model); explicit commands work on any turn.
+    if local_math_engine is None:
+        return None
+    user_input = _latest_user_message(conversation_history)
+    if not (_is_standalone_question(conversation_history) or _MATH_COMMAND_RE.match(user_input)):
+        return None
+    return local_math_engine.solve(user_input)
+
+
+def _semantic_route(conversation_history, use_cache):
+    # Returns (stored_answer, conversation_history). In "reuse" mode a standalone question that
+    # closely matches a past one with the same numbers and symbols is answered from the index;
+    # in "context" mode the closest past pair is handed to the model as a hint instead.
+    if semantic_index is None or not use_cache:
+        return None, conversation_history
+    if SEMANTIC_MODE != "context":
+        if not _is_standalone_question(conversation_history):
+            return None, conversation_history
+        match = semantic_index.lookup(_latest_user_message(conversation_history),
+                                      _system_prompt_key(conversation_history))
+        if match is None:
+            return None, conversation_history
+        logging.debug(f"Request served by semantic index (similarity {match['similarity']}).")
+        return match["answer"], conversation_history
+    match = semantic_index.lookup(_latest_user_message(conversation_history), require_same_question=False)
+    if match is None:
+        return None, conversation_history
+    hint = {"role": "system", "content": "A similar question was answered earlier; use it only if it applies.\n"
+                                         f"Question: {match['question']}\nAnswer: {match['answer']}"}
+    return None, conversation_history[:-1] + [hint] + conversation_history[-1:]
+
+
+def _remember_answer(conversation_history, answer, use_cache):
+    if (semantic_index is not None and use_cache and answer and not _is_llm_error(answer)
+            and _is_standalone_question(conversation_history)):
+        semantic_index.add(_latest_user_message(conversation_history), answer, _system_prompt_key(conversation_history))
+
+
+def _remember_streamed_answer(conversation_history, deltas, use_cache):
+    chunks = []
+    for delta in deltas:
+        chunks.append(delta)
+        yield delta
+    _remember_answer(conversation_history, _join_stream(chunks), use_cache)
+
+
+def route_llm_request(conversation_history, temperature, max_tokens, use_cache=True, priority=PRIORITY_DEFAULT):
+    # Returns (response, served_by), where served_by is "local_math" or "llm".
+    local_answer = _local_math_answer(conversation_history)
+    if local_answer is not None:
+        _count_route("local_math")
+        logging.debug("Request served by local math engine.")
+        return local_answer, "local_math"
+    stored_answer, conversation_history = _semantic_route(conversation_history, use_cache)
+    if stored_answer is not None:
+        _count_route("semantic_cache")
+        return stored_answer, "semantic_cache"
+    _count_route("llm")
+    llm_response = get_llm_response(conversation_history, temperature, max_tokens, use_cache=use_cache, priority=priority)
+    _remember_answer(conversation_history, llm_response, use_cache)
+    return llm_response, "llm"
+
+
+def route_llm_stream(conversation_history, temperature, max_tokens, use_cache=True, priority=PRIORITY_DEFAULT):
+    # Streaming counterpart of route_llm_request: returns (served_by, iterator of deltas).
+    local_answer = _local_math_answer(conversation_history)
+    if local_answer is not None:
+        _count_route("local_math")
+        logging.debug("Streaming request served by local math engine.")
+        return "local_math", iter([local_answer])
+    stored_answer, conversation_history = _semantic_route(conversation_history, use_cache)
+    if stored_answer is not None:
+        _count_route("semantic_cache")
+        return "semantic_cache", iter([stored_answer])
+    _count_route("llm")
+    deltas = stream_llm_response(conversation_history, temperature, max_tokens, use_cache=use_cache, priority=priority)
+    return "llm", _remember_streamed_answer(conversation_history, deltas, use_cache)
+
+
+# -----------------------------------------------------------------------------
+# Conversation History Management
+# -----------------------------------------------------------------------------
+HISTORY_SUMMARY_PREFIX = "Summary of the earlier conversation:"
+
+
+class ConversationHistory:
+    # Keeps the system prompt plus as many recent turns as fit in a token budget.
+    # Each message is measured once when appended and a running total is kept, so
+    # trimming costs O(1) per evicted turn instead of re-measuring the whole list.
+    # In "summary" mode evicted turns are later folded into a rolling summary written
+    # by the model itself (see refresh_summary); in "window" mode they are dropped.
+    # Turns are stored as plain tuples (and __slots__ is used) because the HTTP session
+    # store keeps thousands of these alive at once.
+    __slots__ = ("system_message", "max_context_tokens", "mode", "chars_per_token", "_lock", "_turns",
+                 "_turn_tokens", "_system_tokens", "_summary", "_summary_tokens", "_evicted")
+
+    def __init__(self, system_prompt, max_context_tokens=3072, mode="window", chars_per_token=4):
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.max_context_tokens = max_context_tokens
+        self.mode = mode
+        self.chars_per_token = max(1, chars_per_token)
+        self._lock = threading.RLock()
+        self._turns = deque() # (role, content, estimated_tokens)
+        self._turn_tokens = 0
+        self._system_tokens = self.estimate_tokens(system_prompt)
+        self._summary = ""
+        self._summary_tokens = 0
+        self._evicted = [] # Turns awaiting summarisation ("summary" mode only)
+
+    def estimate_tokens(self, text):
+        return len(text) // self.chars_per_token + 4 # +4 for per-message role/formatting overhead
+
+    def append(self, role, content):
+        tokens = self.estimate_tokens(content)
+        with self._lock:
+            self._turns.append((role, content, tokens))
+            self._turn_tokens += tokens
+            self._trim()
+
+    def _trim(self):
+        # The newest turn is always kept, even if it alone exceeds the budget.
+        while len(self._turns) > 1 and self.token_count() > self.max_context_tokens:
+            role, content, tokens = self._turns.popleft()
+            self._turn_tokens -= tokens
+            if self.mode == "summary":
+                self._evicted.append({"role": role, "content": content})
+
+    def token_count(self):
+        return self._system_tokens + self._summary_tokens + self._turn_tokens
+
+    def messages(self):
+        with self._lock:
+            payload = [self.system_message]
+            if self._summary:
+                payload.append({"role": "system", "content": f"{HISTORY_SUMMARY_PREFIX} {self._summary}"})
+            payload.extend({"role": role, "content": content} for role, content, _ in self._turns)
+            return payload
+
+    def last_role(self):
+        with self._lock:
+            return self._turns[-1][0] if self._turns else None
+
+    def needs_summary(self):
+        with self._lock:
+            return bool(self._evicted)
+
+    def refresh_summary(self, summarize):
+        # summarize(previous_summary, evicted_messages) returns the new summary text or None.
+        # Runs the (slow) model call outside the lock so the GUI can keep appending turns.
+        with self._lock:
+            evicted, self._evicted = self._evicted, []
+            previous_summary = self._summary
+        if not evicted:
+            return
+        summary = summarize(previous_summary, evicted)
+        if not summary:
+            logging.warning(f"Conversation summary failed; {len(evicted)} older turns dropped from context.")
+            return
+        with self._lock:
+            self._summary = summary
+            self._summary_tokens = self.estimate_tokens(summary)
+            self._trim()
+
+    def to_dict(self):
+        with self._lock:
+            return {"summary": self._summary, "turns": [[role, content] for role, content, _ in self._turns]}
+
+    @classmethod
+    def from_dict(cls, data, system_prompt, **kwargs):
+        history = cls(system_prompt, **kwargs)
+        if data.get("summary"):
+            history._summary = data["summary"]
+            history._summary_tokens = history.estimate_tokens(data["summary"])
+        for role, content in data.get("turns", []):
+            history.append(role, content)
+        return history
+
+    def __len__(self):
+        with self._lock:
+            return 1 + len(self._turns)
+
+
+def summarize_conversation(previous_summary, messages):
+    # Asks the model to fold older turns into a short running summary.
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    if previous_summary:
+        transcript = f"Existing summary: {previous_summary}\n\nNew turns:\n{transcript}"
+    summary_history = [
+        {"role": "system", "content": "Summarize this tutoring conversation in a few sentences. Keep every "
+                                      "problem statement, key result and open question; omit pleasantries."},
+        {"role": "user", "content": transcript}
+    ]
+    summary = get_llm_response(summary_history, TEMPERATURE, HISTORY_SUMMARY_MAX_TOKENS, use_cache=False,
+                               priority=PRIORITY_BATCH) # Background work, never ahead of a live turn
+    return None if _is_llm_error(summary) else summary
+
+
+# -----------------------------------------------------------------------------
+# HTTP Session Store
+# -----------------------------------------------------------------------------
+HTTP_SYSTEM_PROMPT = "You are a helpful AI assistant responding via HTTP."
+_SESSION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,128}$")
+
+
+class SessionStore:
+    # Server-side conversation state for HTTP clients, keyed by an opaque session id.
+    # Live sessions sit in an LRU capped at max_sessions, and each history is trimmed to
+    # max_context_tokens, so memory stays bounded however many clients connect. Sessions
+    # idle for longer than idle_timeout_seconds expire. When db_path is set every turn is
+    # written through to SQLite, so a session evicted from memory (or lost to a restart)
+    # is reloaded on its next request.
+    def __init__(self, system_prompt, max_sessions=5000, idle_timeout_seconds=1800, max_context_tokens=1024,
+                 chars_per_token=4, db_path=None):
+        self.system_prompt = system_prompt
+        self.max_sessions = max_sessions
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.max_context_tokens = max_context_tokens
+        self.chars_per_token = chars_per_token
+        self.created = 0
+        self.expired = 0
+        self.evictions = 0
+        self._sessions = OrderedDict() # session_id -> (last_access, ConversationHistory), oldest first
+        self._lock = threading.Lock()
+        self._db = None
+        self._disk_writes = 0
+        if db_path:
+            try:
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute("CREATE TABLE IF NOT EXISTS sessions "
+                                 "(session_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)")
+                self._purge_expired_from_disk()
+                self._db.commit()
+                logging.info(f"HTTP sessions persisted to {db_path}.")
+            except sqlite3.Error as e:
+                logging.error(f"Could not open session database {db_path}: {e}. Using memory only.")
+                self._db = None
+
+    @staticmethod
+    def new_session_id():
+        return uuid.uuid4().hex
+
+    @staticmethod
+    def is_valid_session_id(session_id):
+        return isinstance(session_id, str) and _SESSION_ID_RE.match(session_id) is not None
+
+    def _is_expired(self, last_access):
+        return self.idle_timeout_seconds > 0 and time.time() - last_access > self.idle_timeout_seconds
+
+    def _purge_expired_from_disk(self):
+        if self.idle_timeout_seconds > 0:
+            self._db.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.idle_timeout_seconds,))
+
+    def _new_history(self, state=None):
+        kwargs = {"max_context_tokens": self.max_context_tokens, "mode": "window", "chars_per_token": self.chars_per_token}
+        if state is None:
+            return ConversationHistory(self.system_prompt, **kwargs)
+        return ConversationHistory.from_dict(state, self.system_prompt, **kwargs)
+
+    def _expire_idle(self):
+        # The dict is kept in access order, so expired sessions are always at the front.
+        while self._sessions:
+            session_id, (last_access, _) = next(iter(self._sessions.items()))
+            if not self._is_expired(last_access):
+                break
+            del self._sessions[session_id]
+            self.expired += 1
+
+    def _remember(self, session_id, history):
+        self._sessions[session_id] = (time.time(), history)
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, session_id):
+        # Returns the session's ConversationHistory, creating an empty one for unknown ids.
+        with self._lock:
+            self._expire_idle()
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                history = entry[1]
+            else:
+                history = None
+                if self._db is not None:
+                    try:
+                        row = self._db.execute("SELECT state, updated_at FROM sessions WHERE session_id = ?",
+                                               (session_id,)).fetchone()
+                    except sqlite3.Error as e:
+                        logging.error(f"Session read failed: {e}")
+                        row = None
+                    if row is not None and not self._is_expired(row[1]):
+                        try:
+                            history = self._new_history(json.loads(row[0]))
+                        except (ValueError, TypeError) as e:
+                            logging.error(f"Discarding unreadable session {session_id}: {e}")
+                if history is None:
+                    history = self._new_history()
+                    self.created += 1
+            self._remember(session_id, history)
+            return history
+
+    def save(self, session_id, history):
+        with self._lock:
+            self._remember(session_id, history)
+            if self._db is None:
+                return
+            try:
+                self._db.execute("INSERT OR REPLACE INTO sessions (session_id, state, updated_at) VALUES (?, ?, ?)",
+                                 (session_id, json.dumps(history.to_dict()), time.time()))
+                self._disk_writes += 1
+                if self._disk_writes % 100 == 0: # Drop idle sessions from disk every so often
+                    self._purge_expired_from_disk()
+                self._db.commit()
+            except sqlite3.Error as e:
+                logging.error(f"Session write failed: {e}")
+
+    def delete(self, session_id):
+        with self._lock:
+            found = self._sessions.pop(session_id, None) is not None
+            if self._db is not None:
+                try:
+                    found = self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,)).rowcount > 0 or found
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logging.error(f"Session delete failed: {e}")
+            return found
+
+    def stats(self):
+        with self._lock:
+            self._expire_idle()
+            return {
+                "active": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "created": self.created,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "idle_timeout_seconds": self.idle_timeout_seconds,
+                "max_context_tokens": self.max_context_tokens,
+                "persistent": self._db is not None
+            }
+
+
+session_store = SessionStore(HTTP_SYSTEM_PROMPT, SESSIONS_MAX_SESSIONS, SESSIONS_IDLE_TIMEOUT_SECONDS,
+                             SESSIONS_MAX_CONTEXT_TOKENS, HISTORY_CHARS_PER_TOKEN, SESSIONS_DB_PATH) if SESSIONS_ENABLED else None
 
-# Configuration File Handling
-config = configparser.ConfigParser()
-if not config.read('config.ini'):
-    logging.warning("config.ini not found. Using default fallback values.")
-    # Create a default config object if file not found
-    config['LLM'] = {
-        'endpoint': "http://127.0.0.1:1234/v1/chat/completions",
-        'model_name': "lmstudio-community/Meta-Llama-3-8B-Instruct-GGUF", # A common default
-        'api_key': "lm-studio", # Default for LM Studio
-        'temperature': '1',
-        'max_tokens': '4096'
-    }
-    config['TTS'] = {
-        'enabled_by_default': 'true',
-        'voice_preference': 'male', # 'male', 'female', or part of a voice name
-        'rate': '160'
-    }
-    with open('config.ini', 'w') as configfile: # Create a default config.ini
-        config.write(configfile)
-    logging.info("Created a default config.ini with LLM and TTS settings.")
 
+def _http_message_error(data):
+    # Returns a 400 message for a request body without a usable "message", or with a
+    # "use_cache" that is not a JSON boolean (the string "false" must not mean true), or None.
+    if not isinstance(data, dict) or "message" not in data:
+        return "Invalid request, 'message' field missing."
+    if not isinstance(data["message"], str) or not data["message"].strip():
+        return "Invalid request, 'message' must be a non-empty string."
+    if not isinstance(data.get("use_cache", True), bool):
+        return "Invalid request, 'use_cache' must be true or false."
+    return None
 
-LLM_ENDPOINT = config.get('LLM', 'endpoint', fallback="http://127.0.0.1:1234/v1/chat/completions")
-MODEL_NAME = config.get('LLM', 'model_name', fallback="lmstudio-community/Meta-Llama-3-8B-Instruct-GGUF")
-API_KEY = config.get('LLM', 'api_key', fallback="lm-studio")
-TEMPERATURE = config.getfloat('LLM', 'temperature', fallback=0.7)
-MAX_TOKENS = config.getint('LLM', 'max_tokens', fallback=2048)
 
-TTS_ENABLED_DEFAULT = config.getboolean('TTS', 'enabled_by_default', fallback=True)
-TTS_VOICE_PREF = config.get('TTS', 'voice_preference', fallback='male').lower()
-TTS_RATE = config.getint('TTS', 'rate', fallback=160)
+def _prepare_http_turn(data):
+    # Returns (session_id, history, messages) for an HTTP request body. Requests carrying a
+    # "session_id" key are stateful (an empty id starts a new session); others stay stateless.
+    # Raises ValueError for a malformed id.
+    user_input_text = data["message"]
+    if session_store is None or "session_id" not in data:
+        return None, None, _build_http_conversation_history(user_input_text)
+    session_id = data["session_id"] or session_store.new_session_id()
+    if not session_store.is_valid_session_id(session_id):
+        raise ValueError("Invalid 'session_id': use 1-128 letters, digits, '-' or '_'.")
+    history = session_store.get(session_id)
+    return session_id, history, history.messages() + [{"role": "user", "content": user_input_text}]
 
 
-# Flask App Setup
-app = Flask(__name__)
+def _record_http_turn(session_id, history, user_input_text, llm_response):
+    # Failed turns are not stored so that a retry does not see a dangling question.
+    if history is None or not llm_response or _is_llm_error(llm_response):
+        return
+    history.append("user", user_input_text)
+    history.append("assistant", llm_response)
+    session_store.save(session_id, history)
+
+
+def _build_http_conversation_history(user_input_text):
+    # Stateless history used for requests that do not carry a session id.
+    return [
+        {"role": "system", "content": HTTP_SYSTEM_PROMPT},
+        {"role": "user", "content": user_input_text}
+    ]
 
-# Global Queue for Thread-Safe Communication (primarily for Flask or other integrations)
-response_queue = queue.Queue()
 
 # -----------------------------------------------------------------------------
-# LLM Interaction Function
+# Speech Synthesis Worker
 # -----------------------------------------------------------------------------
-def get_llm_response(conversation_history, temperature, max_tokens):
-    logging.debug("Sending conversation history to LLM...")
-    messages_payload = conversation_history 
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?;:])\s+|\n+")
 
-    logging.debug("Payload sent to LLM: %s", json.dumps(messages_payload, indent=2))
 
-    headers = {
-        "Content-Type": "application/json",
-    }
-    if API_KEY and API_KEY != "None" and API_KEY != "": 
-        headers["Authorization"] = f"Bearer {API_KEY}"
-
-    data = {
-        "model": MODEL_NAME,
-        "messages": messages_payload,
-        "temperature": temperature,
-        "max_tokens": max_tokens,
-        "stream": False
-    }
+def split_sentences(text):
+    return [sentence.strip() for sentence in _SENTENCE_END_RE.split(text) if sentence.strip()]
 
-    try:
-        response = requests.post(LLM_ENDPOINT, headers=headers, data=json.dumps(data), timeout=150) 
-        response.raise_for_status()
-        json_response = response.json()
-        logging.debug("LLM Response JSON: %s", json.dumps(json_response, indent=2))
+
+class SpeechSynthesisWorker(threading.Thread):
+    # Owns the pyttsx3 engine on a dedicated thread so speaking never blocks the Tk main loop.
+    # Text is queued one sentence at a time, so speech starts after the first sentence and
+    # streamed tokens can be fed in as they arrive. interrupt() drops everything queued and
+    # cuts off the sentence currently being spoken.
+    def __init__(self, voice_preference="male", rate=160, on_error=None):
+        super().__init__(daemon=True, name="tts-worker")
+        self.voice_preference = voice_preference
+        self.rate = rate
+        self.on_error = on_error # Called from the worker thread with a short status message
+        self.init_error = None
+        self._queue = queue.Queue()
+        self._ready = threading.Event()
+        self._generation = 0 # Bumped by interrupt(); queued sentences from older generations are skipped
+        self._generation_lock = threading.Lock()
+        self._stream_buffer = ""
+        self.engine = None
+
+    def wait_until_ready(self, timeout=10.0):
+        # Returns True once the engine is initialised, False if it failed or timed out.
+        return self._ready.wait(timeout) and self.init_error is None
+
+    def _init_engine(self):
+        import pyttsx3 # Loaded on the worker thread, only when speech output is used
+        engine = pyttsx3.init()
+        if engine is None: 
+             raise RuntimeError("pyttsx3 engine could not be initialized.")
         
-        if "choices" in json_response and len(json_response["choices"]) > 0:
-            if "message" in json_response["choices"][0] and "content" in json_response["choices"][0]["message"]:
-                 return json_response["choices"][0]["message"]["content"].strip()
-            elif "text" in json_response["choices"][0]: 
-                 return json_response["choices"][0]["text"].strip()
+        voices = engine.getProperty('voices')
+        selected_voice = None
+        for voice in voices: # Prioritize user preference from config
+            if self.voice_preference in voice.name.lower():
+                selected_voice = voice.id
+                break
+        if not selected_voice: # Fallback logic from original code
+            for voice in voices:
+                if "male" in voice.name.lower() or "david" in voice.name.lower() or "zira" not in voice.name.lower() : 
+                    selected_voice = voice.id
+                    break
+        if selected_voice:
+             engine.setProperty('voice', selected_voice)
         
-        if "data" in json_response and len(json_response["data"]) > 0 and "content" in json_response["data"][0]:
-            return json_response["data"][0]["content"].strip()
-
-        logging.error(f"Unexpected LLM response structure: {json_response}")
-        return "Error: Could not parse LLM response."
-
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error communicating with LLM: {e}")
-        return f"Network Error: {e}"
-    except (KeyError, IndexError, TypeError) as e:
-        logging.error(f"Error parsing LLM response: {e}. Response: {json_response if 'json_response' in locals() else 'N/A'}")
-        return f"Parsing Error: {e}"
-    except json.JSONDecodeError as e:
-        logging.error(f"Error decoding JSON from LLM: {e}. Response text: {response.text if 'response' in locals() else 'N/A'}")
-        return f"JSON Decode Error: {e}"
+        engine.setProperty('rate', self.rate) 
+        engine.connect('started-word', self._on_started_word)
+        return engine
+
+    def _on_started_word(self, name, location, length):
+        # pyttsx3 only honours stop() reliably from inside its own callbacks.
+        if name != self._generation:
+            self.engine.stop()
+
+    def run(self):
+        try:
+            self.engine = self._init_engine()
+        except Exception as e:
+            logging.error(f"Failed to initialize speech synthesis: {e}")
+            self.init_error = e
+            self._ready.set()
+            return
+        self._ready.set()
+
+        while True:
+            item = self._queue.get()
+            if item is None: # Shutdown sentinel
+                break
+            generation, sentence = item
+            if generation != self._generation:
+                continue # Interrupted before it was spoken
+            try:
+                with timed_stage("tts"):
+                    self.engine.say(sentence, name=generation)
+                    self.engine.runAndWait()
+            except RuntimeError as e: # pyttsx3 can raise RuntimeError if used incorrectly (e.g. during an existing loop)
+                logging.error(f"Error during speech synthesis (RuntimeError): {e}")
+                if "run loop already started" in str(e).lower():
+                    logging.warning("Speech engine was already in a loop. Attempting to proceed.")
+                elif self.on_error:
+                    self.on_error("Audio Output Error.")
+            except Exception as e:
+                logging.error(f"Error during speech synthesis: {e}")
+                if self.on_error:
+                    self.on_error("Audio Output Error.")
+
+    def speak(self, text):
+        for sentence in split_sentences(text):
+            self._queue.put((self._generation, sentence))
+
+    def feed(self, token):
+        # Streaming input: complete sentences are queued as soon as their boundary arrives.
+        self._stream_buffer += token
+        sentences = _SENTENCE_END_RE.split(self._stream_buffer)
+        if len(sentences) > 1:
+            self._stream_buffer = sentences.pop()
+            for sentence in sentences:
+                if sentence.strip():
+                    self._queue.put((self._generation, sentence.strip()))
+
+    def flush(self):
+        # Speaks whatever is left of a streamed response.
+        remainder, self._stream_buffer = self._stream_buffer, ""
+        if remainder.strip():
+            self._queue.put((self._generation, remainder.strip()))
+
+    def interrupt(self):
+        with self._generation_lock:
+            self._generation += 1
+        self._stream_buffer = ""
+
+    def shutdown(self):
+        self.interrupt()
+        self._queue.put(None)
+
+
+# -----------------------------------------------------------------------------
+# Speech Recognition Backends and Worker
+# -----------------------------------------------------------------------------
+class GoogleSpeechBackend:
+    # Online recognition through the Google Web Speech API (the original behaviour).
+    name = "Google Speech"
+    streaming = False
+
+    def transcribe(self, recognizer, audio):
+        return recognizer.recognize_google(audio)
+
+
+class SphinxSpeechBackend:
+    # Offline, CPU-only recognition through PocketSphinx (pip install pocketsphinx).
+    name = "Sphinx"
+    streaming = False
+
+    def transcribe(self, recognizer, audio):
+        return recognizer.recognize_sphinx(audio)
+
+
+class VoskSpeechBackend:
+    # Offline, CPU-only recognition through Vosk (pip install vosk, plus a downloaded model).
+    # Streams microphone frames into the recogniser so partial results are available live.
+    name = "Vosk"
+    streaming = True
+
+    def __init__(self, model_path):
+        import vosk # Optional dependency
+        if not os.path.isdir(model_path):
+            raise FileNotFoundError(f"Vosk model directory not found: {model_path}")
+        vosk.SetLogLevel(-1)
+        self._vosk = vosk
+        self.model = vosk.Model(model_path)
+
+    def transcribe(self, recognizer, audio):
+        vosk_recognizer = self._vosk.KaldiRecognizer(self.model, audio.sample_rate)
+        vosk_recognizer.AcceptWaveform(audio.get_raw_data(convert_width=2))
+        return self._text(vosk_recognizer.FinalResult())
+
+    def transcribe_stream(self, source, should_stop, on_partial, listen_timeout, phrase_time_limit):
+        # Returns the final text of one utterance, or "" if nothing was said before listen_timeout.
+        # The "stt" stage records time spent in the recogniser for the utterance, not time spent
+        # waiting for microphone audio, so it is comparable with the non-streaming backends.
+        vosk_recognizer = self._vosk.KaldiRecognizer(self.model, source.SAMPLE_RATE)
+        started = time.monotonic()
+        decode_seconds = 0.0
+        last_partial = ""
+        while not should_stop():
+            data = source.stream.read(source.CHUNK)
+            decode_started = time.perf_counter()
+            is_final = vosk_recognizer.AcceptWaveform(data)
+            if is_final:
+                text = self._text(vosk_recognizer.Result())
+            else:
+                text = json.loads(vosk_recognizer.PartialResult()).get("partial", "")
+            decode_seconds += time.perf_counter() - decode_started
+            if is_final and text:
+                record_stage("stt", decode_seconds, backend=self.name)
+                return text
+            if not is_final and text and text != last_partial:
+                last_partial = text
+                on_partial(text)
+            elapsed = time.monotonic() - started
+            if not last_partial and elapsed > listen_timeout:
+                return ""
+            if elapsed > listen_timeout + phrase_time_limit:
+                break
+        decode_started = time.perf_counter()
+        text = self._text(vosk_recognizer.FinalResult())
+        if text:
+            record_stage("stt", decode_seconds + time.perf_counter() - decode_started, backend=self.name)
+        return text
+
+    def _text(self, result_json):
+        return json.loads(result_json).get("text", "").strip()
+
+
+def create_speech_backend(backend_name):
+    # Audio only leaves the machine when 'google' is configured, or when allow_online_fallback
+    # is set and the configured local engine is unavailable. Otherwise a RuntimeError explains
+    # why voice input cannot start.
+    if backend_name == "google":
+        return GoogleSpeechBackend()
+    try:
+        if backend_name == "vosk":
+            return VoskSpeechBackend(STT_VOSK_MODEL_PATH)
+        if backend_name == "sphinx":
+            import pocketsphinx # Optional dependency; only checked so failure is reported at startup
+            return SphinxSpeechBackend()
+        reason = "unknown backend"
+    except Exception as e:
+        reason = str(e) or type(e).__name__
+    if STT_ALLOW_ONLINE_FALLBACK:
+        logging.error(f"Speech backend '{backend_name}' unavailable ({reason}); falling back to Google Speech.")
+        return GoogleSpeechBackend()
+    raise RuntimeError(f"speech backend '{backend_name}' is unavailable ({reason}). Install it, or set "
+                       "[STT] allow_online_fallback = true to use Google Speech instead.")
+
+
+class SpeechInputWorker(threading.Thread):
+    # Captures and transcribes microphone input on a background thread. Ambient noise is
+    # calibrated on the first capture only; the recogniser keeps its threshold afterwards.
+    # capture_once() records a single phrase (push-to-talk); set_continuous(True) keeps
+    # listening and reports every phrase until switched off. Callbacks run on this thread,
+    # so the GUI marshals them onto the Tk main loop.
+    def __init__(self, backend, on_result, on_status, on_partial=None, on_error=None,
+                 calibration_seconds=0.5, listen_timeout=5, phrase_time_limit=10):
+        super().__init__(daemon=True, name="stt-worker")
+        self.backend = backend
+        _import_speech_recognition()
+        self.recognizer = sr.Recognizer()
+        self.on_result = on_result
+        self.on_status = on_status
+        self.on_partial = on_partial or (lambda text: None)
+        self.on_error = on_error or (lambda text: None)
+        self.calibration_seconds = calibration_seconds
+        self.listen_timeout = listen_timeout
+        self.phrase_time_limit = phrase_time_limit
+        self._requests = queue.Queue()
+        self._continuous = threading.Event()
+        self._busy = threading.Event()
+        self._calibrated = False
+
+    @property
+    def busy(self):
+        return self._busy.is_set()
+
+    @property
+    def continuous(self):
+        return self._continuous.is_set()
+
+    def capture_once(self):
+        if not self.busy:
+            self._busy.set()
+            self._requests.put("once")
+
+    def set_continuous(self, enabled):
+        if enabled and not self.continuous:
+            self._continuous.set()
+            self._busy.set()
+            self._requests.put("continuous")
+        elif not enabled:
+            self._continuous.clear() # The capture loop notices and stops after the current phrase
+
+    def shutdown(self):
+        self._continuous.clear()
+        self._requests.put(None)
+
+    def run(self):
+        while True:
+            request = self._requests.get()
+            if request is None: # Shutdown sentinel
+                break
+            try:
+                with sr.Microphone() as source:
+                    if not self._calibrated:
+                        self.on_status("Calibrating microphone...")
+                        self.recognizer.adjust_for_ambient_noise(source, duration=self.calibration_seconds)
+                        self._calibrated = True
+                    if request == "continuous":
+                        while self.continuous:
+                            text = self._capture_phrase(source, should_stop=lambda: not self.continuous)
+                            if text:
+                                self.on_result(text)
+                    else:
+                        self.on_result(self._capture_phrase(source, should_stop=lambda: False))
+            except Exception as e: # Catch other potential microphone/recognition errors
+                logging.error(f"Error during voice input: {e}")
+                self._continuous.clear()
+                self.on_status("Input System Error.")
+                self.on_error(f"An error occurred during voice input: {e}")
+                if request == "once":
+                    self.on_result("")
+            finally:
+                self._busy.clear()
+
+    def _capture_phrase(self, source, should_stop):
+        # Returns the recognised text, or "" after reporting why nothing was recognised.
+        self.on_status("Listening intently...")
+        try:
+            if self.backend.streaming:
+                user_input = self.backend.transcribe_stream(source, should_stop, self.on_partial,
+                                                            self.listen_timeout, self.phrase_time_limit)
+                if not user_input:
+                    raise sr.WaitTimeoutError("listening timed out while waiting for phrase to start")
+            else:
+                audio = self.recognizer.listen(source, timeout=self.listen_timeout, phrase_time_limit=self.phrase_time_limit)
+                self.on_status("Decoding Input...")
+                with timed_stage("stt", backend=self.backend.name):
+                    user_input = self.backend.transcribe(self.recognizer, audio)
+            logging.info(f"Voice input recognized: {user_input}")
+            return user_input
+        except sr.WaitTimeoutError:
+            if not self.continuous:
+                self.on_status("No speech detected in time.")
+                logging.warning("Voice input: No speech detected.")
+            return "" # Return empty string for no speech
+        except sr.UnknownValueError:
+            logging.warning(f"{self.backend.name} recognition could not understand audio")
+            self.on_status("Input Garbled. Try Again.")
+            return ""
+        except sr.RequestError as e:
+            logging.error(f"Could not request results from {self.backend.name} recognition; {e}")
+            self.on_status(f"Comms Relay Error ({self.backend.name}).")
+            return ""
 
 
 # -----------------------------------------------------------------------------
@@ -118,7 +2630,9 @@ class ChatbotGUI:
         self.master = master
         master.title("NovaChat Terminal v1.8") # Version bump
 
-        self.conversation_history = [{"role": "system", "content": "You are Nova, a helpful AI assistant operating within the NovaChat Terminal. Be concise and slightly futuristic in your responses."}]
+        self.conversation_history = ConversationHistory("You are Nova, a helpful AI assistant operating within the NovaChat Terminal. Be concise and slightly futuristic in your responses.",
+                                                        max_context_tokens=HISTORY_MAX_CONTEXT_TOKENS, mode=HISTORY_MODE,
+                                                        chars_per_token=HISTORY_CHARS_PER_TOKEN)
         self.bg_color = "#1E1E1E"
         self.text_area_bg = "#2D2D2D"
         self.text_color = "#76D7C4"
@@ -140,6 +2654,22 @@ class ChatbotGUI:
                                                   bg=self.text_area_bg, fg=self.text_color,
                                                   font=self.base_font, relief=tk.FLAT, borderwidth=2)
         self.chat_log.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
+        # Sender tags are configured once here rather than on every message.
+        self.chat_log.tag_configure("nova_sender", font=self.bold_font, foreground=self.accent_color)
+        self.chat_log.tag_configure("operator_sender", font=self.bold_font, foreground=self.text_color)
+        self._message_marks = deque() # One mark per rendered message, oldest first
+        self._message_serial = 0
+        self._pending_tokens = [] # Streamed tokens waiting for the next refresh
+        self._pending_tokens_lock = threading.Lock()
+        self._token_flush_scheduled = False
+
+        # The window only keeps the newest messages; the full session goes to the transcript file.
+        self.transcript_file = None
+        if GUI_TRANSCRIPT_PATH:
+            try:
+                self.transcript_file = open(GUI_TRANSCRIPT_PATH, "a", encoding="utf-8")
+            except OSError as e:
+                logging.error(f"Could not open transcript file {GUI_TRANSCRIPT_PATH}: {e}")
         
         self.status_label = tk.Label(master, text="", bg=self.bg_color, fg=self.accent_color, font=self.bold_font)
         self.status_label.pack(padx=10, pady=(0, 5), fill=tk.X)
@@ -182,37 +2712,37 @@ class ChatbotGUI:
                                               disabledforeground="#AAAAAA")
         self.speech_toggle_button.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(2,0))
 
+        speech_init_errors = []
         try:
-            self.recognizer = sr.Recognizer()
-            self.engine = pyttsx3.init()
-            if self.engine is None: 
-                 raise RuntimeError("pyttsx3 engine could not be initialized.")
-            
-            voices = self.engine.getProperty('voices')
-            selected_voice = None
-            for voice in voices: # Prioritize user preference from config
-                if TTS_VOICE_PREF in voice.name.lower():
-                    selected_voice = voice.id
-                    break
-            if not selected_voice: # Fallback logic from original code
-                for voice in voices:
-                    if "male" in voice.name.lower() or "david" in voice.name.lower() or "zira" not in voice.name.lower() : 
-                        selected_voice = voice.id
-                        break
-            if selected_voice:
-                 self.engine.setProperty('voice', selected_voice)
-            
-            self.engine.setProperty('rate', TTS_RATE) 
+            # Speech input is captured and decoded on its own thread; results come back via after().
+            self.stt_worker = SpeechInputWorker(
+                create_speech_backend(STT_BACKEND),
+                on_result=lambda text: self.master.after(0, self.handle_voice_input_action, text),
+                on_status=lambda text: self.master.after(0, self.status_label.config, {"text": text}),
+                on_partial=lambda text: self.master.after(0, self.status_label.config, {"text": f"Hearing: {text}"}),
+                on_error=lambda text: self.master.after(0, messagebox.showerror, "Input Error", text),
+                calibration_seconds=STT_CALIBRATION_SECONDS, listen_timeout=STT_LISTEN_TIMEOUT,
+                phrase_time_limit=STT_PHRASE_TIME_LIMIT)
+            self.stt_worker.start()
         except Exception as e:
-            logging.error(f"Failed to initialize speech components: {e}")
-            self.recognizer = None
-            self.engine = None
+            logging.error(f"Failed to initialize speech recognition: {e}")
+            self.stt_worker = None
             self.voice_button.config(state=tk.DISABLED, text="Vocal Comms (N/A)")
+            self.status_label.config(text="Voice input disabled: speech recognition is unavailable.")
+            speech_init_errors.append(f"Voice input: {e}")
+
+        # Speech output runs on its own thread; status updates are marshalled back via after().
+        self.tts_worker = SpeechSynthesisWorker(TTS_VOICE_PREF, TTS_RATE,
+                                                on_error=lambda text: self.master.after(0, self.status_label.config, {"text": text}))
+        self.tts_worker.start()
+        if not self.tts_worker.wait_until_ready():
+            speech_init_errors.append(f"Voice output: {self.tts_worker.init_error or 'engine did not start in time'}")
+            self.tts_worker.shutdown()
+            self.tts_worker = None
             self.speech_toggle_button.config(state=tk.DISABLED, text="Speech (N/A)") # Disable toggle too
-            messagebox.showwarning("Speech Init Error", f"Could not initialize speech services: {e}\nVoice input and output will be disabled.")
-        
-        if not self.engine: # Double check if engine init failed and disable toggle button
-             self.speech_toggle_button.config(state=tk.DISABLED, text="Speech (N/A)")
+
+        if speech_init_errors:
+            messagebox.showwarning("Speech Init Error", "Could not initialize speech services:\n" + "\n".join(speech_init_errors) + "\nThe affected features will be disabled.")
 
         self.master.protocol("WM_DELETE_WINDOW", self.on_closing)
         self.display_message("Nova: Greetings Operator. NovaChat Terminal online. How may I assist you?", sender="Nova", speak=self.speech_synthesis_enabled)
@@ -222,18 +2752,11 @@ class ChatbotGUI:
         if self.speech_synthesis_enabled:
             self.speech_toggle_button.config(text="Speech: ON")
             logging.info("Speech synthesis enabled by user.")
-            # Optionally, say "Speech enabled"
-            # if self.engine:
-            #     self.engine.say("Speech enabled")
-            #     self.engine.runAndWait()
         else:
             self.speech_toggle_button.config(text="Speech: OFF")
             logging.info("Speech synthesis disabled by user.")
-            if self.engine:
-                self.engine.stop() # Stop any ongoing speech
-            # Optionally, say "Speech disabled" using a temporary say then stop or direct system sound
-            # This is tricky as self.engine.say itself would be blocked by the toggle.
-            # For simplicity, no audio feedback on toggle OFF if speech was ON.
+            if self.tts_worker:
+                self.tts_worker.interrupt() # Stop current and queued speech
 
     def on_entry_focus_in(self, event):
         if self.input_field.cget('fg') == self.placeholder_color:
@@ -256,64 +2779,44 @@ class ChatbotGUI:
             return
 
         self.display_message(user_input, sender="Operator", speak=False) # User input is not spoken
-        self.conversation_history.append({"role": "user", "content": user_input})
+        self.conversation_history.append("user", user_input)
         
         self.input_field.delete(0, tk.END)
         self.on_entry_focus_out(None) # Reset placeholder if field is empty
 
         self._trigger_llm_response_generation()
 
-    def handle_voice_input_action(self):
-        if not self.recognizer:
+    def handle_voice_input_action(self, user_input=None):
+        # Called by the voice button (user_input is None) to start listening, and by the speech
+        # worker via after() with the recognised text.
+        if not self.stt_worker:
             self.status_label.config(text="Input Offline.")
             return
 
-        self.status_label.config(text="Receiving Input (Speak Now)...")
-        self.master.update_idletasks() 
-        
-        user_input = self._get_voice_input()
-        
-        if not user_input: # Handles empty string from _get_voice_input
+        if user_input is None:
+            if STT_CONTINUOUS:
+                listening = not self.stt_worker.continuous
+                self.stt_worker.set_continuous(listening)
+                self.voice_button.config(text="Stop listening" if listening else "Voice input")
+                self.status_label.config(text="Receiving Input (Speak Now)..." if listening else "Listening stopped.")
+            elif not self.stt_worker.busy:
+                self.status_label.config(text="Receiving Input (Speak Now)...")
+                self.stt_worker.capture_once()
+            return
+
+        if not user_input: # Handles empty string from the speech worker
             self.status_label.config(text="Input Unclear or Cancelled.")
             return
 
+        if str(self.action_button.cget('state')) == tk.DISABLED:
+            logging.info(f"Voice input ignored while a response is being generated: {user_input}")
+            return # Continuous listening can deliver phrases mid-response
+
         self.display_message(user_input, sender="Operator (Vocal)", speak=False) # User input is not spoken
-        self.conversation_history.append({"role": "user", "content": user_input})
+        self.conversation_history.append("user", user_input)
         self.status_label.config(text="NovaCore Processing Input...")
         self._trigger_llm_response_generation()
 
-    def _get_voice_input(self):
-        try:
-            with sr.Microphone() as source:
-                self.recognizer.adjust_for_ambient_noise(source, duration=0.5)
-                self.status_label.config(text="Listening intently...")
-                self.master.update_idletasks()
-                try:
-                    audio = self.recognizer.listen(source, timeout=5, phrase_time_limit=10)
-                except sr.WaitTimeoutError:
-                    self.status_label.config(text="No speech detected in time.")
-                    logging.warning("Voice input: No speech detected.")
-                    return "" # Return empty string for no speech
-            
-            self.status_label.config(text="Decoding Input...")
-            self.master.update_idletasks()
-            user_input = self.recognizer.recognize_google(audio)
-            logging.info(f"Voice input recognized: {user_input}")
-            return user_input
-        except sr.UnknownValueError:
-            logging.warning("Google Speech Recognition could not understand audio")
-            self.status_label.config(text="Input Garbled. Try Again.")
-            return ""
-        except sr.RequestError as e:
-            logging.error(f"Could not request results from Google Speech Recognition service; {e}")
-            self.status_label.config(text="Comms Relay Error (Google Speech).")
-            return ""
-        except Exception as e: # Catch other potential microphone/recognition errors
-            logging.error(f"Error during voice input: {e}")
-            self.status_label.config(text="Input System Error.")
-            messagebox.showerror("Input Error", f"An error occurred during voice input: {e}")
-            return ""
-
     def _trigger_llm_response_generation(self):
         self.action_button.config(state=tk.DISABLED)
         self.voice_button.config(state=tk.DISABLED)
@@ -324,42 +2827,91 @@ class ChatbotGUI:
 
     def _get_and_process_llm_response_thread(self):
         try:
-            if not self.conversation_history or self.conversation_history[-1]["role"] != "user":
+            if self.conversation_history.last_role() != "user":
                 logging.warning("Attempted to generate response without preceding user input.")
                 self.master.after(0, self._update_ui_after_llm, "Error: Internal state anomaly. No user input to respond to.")
                 return
 
-            llm_response = get_llm_response(self.conversation_history, TEMPERATURE, MAX_TOKENS)
-            logging.debug("LLM Raw Response: %s", llm_response)
-            # Schedule UI update and speech on the main thread
-            self.master.after(0, self._update_ui_after_llm, llm_response) 
+            if STREAM_RESPONSES:
+                self._stream_llm_response_to_ui()
+            else:
+                llm_response, served_by = route_llm_request(self.conversation_history.messages(), TEMPERATURE, MAX_TOKENS,
+                                                            priority=PRIORITY_INTERACTIVE)
+                logging.debug("LLM Raw Response (served by %s): %s", served_by, llm_response)
+                # Schedule UI update and speech on the main thread
+                self.master.after(0, self._update_ui_after_llm, llm_response) 
+
+            # Fold turns that fell out of the context window into the rolling summary,
+            # after the reply is on screen so it never delays the answer.
+            if self.conversation_history.needs_summary():
+                self.conversation_history.refresh_summary(summarize_conversation)
         except Exception as e: 
             logging.error(f"Critical error during LLM interaction thread: {e}", exc_info=True)
             self.master.after(0, self._update_ui_after_llm, f"Critical System Error: {e}")
 
-    def _update_ui_after_llm(self, llm_response):
+    def _stream_llm_response_to_ui(self):
+        # Runs on the worker thread. Tokens are buffered and drawn by the Tk main thread at
+        # most once every GUI_STREAM_REFRESH_MS, instead of one after() call per token.
+        served_by, deltas = route_llm_stream(self.conversation_history.messages(), TEMPERATURE, MAX_TOKENS,
+                                             priority=PRIORITY_INTERACTIVE)
+        self.master.after(0, self._begin_streamed_message)
+        chunks = []
+        for delta in deltas:
+            chunks.append(delta)
+            self._queue_streamed_token(delta)
+        llm_response = _join_stream(chunks)
+        logging.debug("LLM Raw Response (streamed, served by %s): %s", served_by, llm_response)
+        if not llm_response:
+            llm_response = LLMError("Error: LLM returned an empty response.")
+            self._queue_streamed_token(llm_response)
+        self.master.after(0, self._finish_streamed_message, llm_response)
+
+    def _queue_streamed_token(self, token):
+        with self._pending_tokens_lock:
+            self._pending_tokens.append(token)
+            if self._token_flush_scheduled:
+                return
+            self._token_flush_scheduled = True
+        self.master.after(GUI_STREAM_REFRESH_MS, self._flush_streamed_tokens)
+
+    def _begin_streamed_message(self):
+        self.status_label.config(text="NovaCore Transmitting...")
+        self.display_message("", sender="Nova", speak=False) # Header only, tokens follow
+        if self.tts_worker:
+            self.tts_worker.interrupt() # A new answer replaces anything still being spoken
+
+    def _flush_streamed_tokens(self):
+        with self._pending_tokens_lock:
+            text = "".join(self._pending_tokens)
+            self._pending_tokens.clear()
+            self._token_flush_scheduled = False
+        if not text:
+            return
+        if self.speech_synthesis_enabled and self.tts_worker:
+            self.tts_worker.feed(text) # Speech starts as soon as the first sentence completes
+        self.chat_log.config(state=tk.NORMAL)
+        self.chat_log.insert(tk.END, text)
+        self.chat_log.config(state=tk.DISABLED)
+        self.chat_log.yview(tk.END)
+
+    def _finish_streamed_message(self, llm_response):
+        self._flush_streamed_tokens() # Draw whatever arrived since the last refresh
+        self._write_transcript("Nova", llm_response)
+        self._update_ui_after_llm(llm_response, already_displayed=True)
+
+    def _update_ui_after_llm(self, llm_response, already_displayed=False):
         # Display message first, then attempt to speak
-        self.display_message(llm_response, sender="Nova", speak=False) # Display handles text
-        self.conversation_history.append({"role": "assistant", "content": llm_response})
+        if not already_displayed: # Streamed responses were rendered token by token
+            self.display_message(llm_response, sender="Nova", speak=False) # Display handles text
+        self.conversation_history.append("assistant", llm_response)
         
-        # Conditional speech synthesis based on toggle
-        if self.speech_synthesis_enabled and self.engine:
-            try:
-                # Stop any previous speech before starting new one,
-                # in case of rapid responses or if user toggled speech off then on quickly.
-                self.engine.stop()
-                self.engine.say(llm_response)
-                self.engine.runAndWait()
-            except RuntimeError as e: # pyttsx3 can raise RuntimeError if used incorrectly (e.g. during an existing loop)
-                logging.error(f"Error during speech synthesis (RuntimeError): {e}")
-                # Try to re-initialize or recover if possible, or just log
-                if "run loop already started" in str(e).lower():
-                    logging.warning("Speech engine was already in a loop. Attempting to proceed.")
-                else:
-                    self.status_label.config(text="Audio Output Error.")
-            except Exception as e:
-                logging.error(f"Error during speech synthesis: {e}")
-                self.status_label.config(text="Audio Output Error.")
+        # Conditional speech synthesis based on toggle; the worker thread does the speaking
+        if self.speech_synthesis_enabled and self.tts_worker:
+            if already_displayed:
+                self.tts_worker.flush() # Streamed sentences were queued as they completed
+            else:
+                self.tts_worker.interrupt()
+                self.tts_worker.speak(llm_response)
 
         self.status_label.config(text="Awaiting Input...") # Clear status or set to ready
         self.action_button.config(state=tk.NORMAL)
@@ -372,35 +2924,57 @@ class ChatbotGUI:
         self.chat_log.config(state=tk.NORMAL)
         if self.chat_log.index('end-1c') != "1.0": 
             self.chat_log.insert(tk.END, "\n\n") # Add more space between messages
-        
-        sender_tag = f"{sender}_tag"
-        self.chat_log.tag_configure(sender_tag, font=self.bold_font)
-        if sender == "Nova":
-            self.chat_log.tag_configure(sender_tag, foreground=self.accent_color) # Nova in accent
-        else: # Operator or System
-            self.chat_log.tag_configure(sender_tag, foreground=self.text_color)
 
+        # A left-gravity mark at the start of each message lets old ones be cut off cheaply.
+        mark = f"message{self._message_serial}"
+        self._message_serial += 1
+        self.chat_log.mark_set(mark, "end-1c")
+        self.chat_log.mark_gravity(mark, tk.LEFT)
+        self._message_marks.append(mark)
 
+        sender_tag = "nova_sender" if sender == "Nova" else "operator_sender" # Nova in accent
         self.chat_log.insert(tk.END, f"{sender}: ", sender_tag)
         self.chat_log.insert(tk.END, message) # Message in base font/color
+        self._trim_chat_log()
         self.chat_log.config(state=tk.DISABLED)
         self.chat_log.yview(tk.END) 
+        if message: # Streamed replies are written once complete
+            self._write_transcript(sender, message)
 
         # Initial greeting speech is handled here, subsequent ones in _update_ui_after_llm
-        if speak and self.speech_synthesis_enabled and self.engine:
-             try:
-                self.engine.stop()
-                self.engine.say(message)
-                self.engine.runAndWait()
-             except Exception as e:
-                logging.error(f"Error during initial speech synthesis: {e}")
+        if speak and self.speech_synthesis_enabled and self.tts_worker:
+            self.tts_worker.interrupt()
+            self.tts_worker.speak(message)
 
+    def _trim_chat_log(self):
+        # Keeps the widget (and Tk's text index) bounded in long-running sessions.
+        while len(self._message_marks) > GUI_MAX_RENDERED_MESSAGES:
+            oldest = self._message_marks.popleft()
+            self.chat_log.delete("1.0", self._message_marks[0])
+            self.chat_log.mark_unset(oldest)
+
+    def _write_transcript(self, sender, message):
+        if self.transcript_file is None:
+            return
+        try:
+            self.transcript_file.write(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {sender}: {message}\n")
+            self.transcript_file.flush()
+        except OSError as e:
+            logging.error(f"Could not write to transcript file: {e}")
+            self.transcript_file = None
 
     def on_closing(self):
         if messagebox.askokcancel("Deactivate NovaChat", "Confirm deactivation of NovaChat Terminal?"):
             logging.info("NovaChat Terminal shutting down.")
-            if self.engine:
-                self.engine.stop() # Ensure any ongoing speech is stopped
+            if self.tts_worker:
+                self.tts_worker.shutdown() # Ensure any ongoing speech is stopped
+            if self.stt_worker:
+                self.stt_worker.shutdown()
+            if request_scheduler is not None:
+                request_scheduler.close()
+            llm_client.close()
+            if self.transcript_file is not None:
+                self.transcript_file.close()
             self.master.destroy()
             # Note: Flask thread is daemon, will exit when main thread exits.
             
@@ -419,35 +2993,659 @@ def index():
         return "NovaChat Web Interface. Error: Template not found. See logs.", 500
 
 
+def _sse_event(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def _record_request_metrics(response):
+    started = getattr(g, "request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        metrics.observe("chatbot_http_request_duration_seconds", time.perf_counter() - started, route=route)
+        metrics.inc("chatbot_http_requests_total", route=route, status=response.status_code)
+    return response
+
+
+def _component_metric_lines():
+    # Point-in-time values from the cache, router, scheduler, coalescer and session store,
+    # which keep their own counters; these are rendered next to the registry's own metrics.
+    samples = [("chatbot_route_requests_total", "counter", [({"served_by": name}, count)
+                                                           for name, count in route_stats().items()])]
+    if response_cache is not None:
+        cache = response_cache.stats()
+        samples += [("chatbot_cache_hits_total", "counter", [({}, cache["hits"])]),
+                    ("chatbot_cache_misses_total", "counter", [({}, cache["misses"])]),
+                    ("chatbot_cache_evictions_total", "counter", [({}, cache["evictions"])]),
+                    ("chatbot_cache_entries", "gauge", [({}, cache["size"])])]
+    coalescing = coalescing_stats()
+    if coalescing["enabled"]:
+        samples += [("chatbot_coalesced_requests_total", "counter", [({}, coalescing["coalesced"])]),
+                    ("chatbot_coalesce_in_flight", "gauge", [({}, coalescing["in_flight"])])]
+    if request_scheduler is not None:
+        scheduler = request_scheduler.stats()
+        samples += [("chatbot_scheduler_queued", "gauge", [({"lane": lane}, count)
+                                                           for lane, count in scheduler["queued"].items()]),
+                    ("chatbot_scheduler_in_flight", "gauge", [({}, scheduler["in_flight"])]),
+                    ("chatbot_scheduler_bursts_total", "counter", [({}, scheduler["bursts"])]),
+                    ("chatbot_scheduler_expired_total", "counter", [({}, scheduler["expired"])])]
+    if isinstance(llm_client, LLMRouter):
+        backends = llm_client.stats()
+        for field, name, kind in (("outstanding", "chatbot_backend_outstanding", "gauge"),
+                                  ("requests", "chatbot_backend_requests_total", "counter"),
+                                  ("failures", "chatbot_backend_failures_total", "counter"),
+                                  ("healthy", "chatbot_backend_healthy", "gauge"),
+                                  ("circuit_open", "chatbot_backend_circuit_open", "gauge")):
+            samples.append((name, kind, [({"backend": backend}, int(stats[field])) for backend, stats in backends.items()]))
+    if session_store is not None:
+        sessions = session_store.stats()
+        samples += [("chatbot_sessions_active", "gauge", [({}, sessions["active"])]),
+                    ("chatbot_sessions_created_total", "counter", [({}, sessions["created"])]),
+                    ("chatbot_sessions_expired_total", "counter", [({}, sessions["expired"])]),
+                    ("chatbot_sessions_evicted_total", "counter", [({}, sessions["evictions"])])]
+    if semantic_index is not None:
+        semantic = semantic_index.stats()
+        samples += [("chatbot_semantic_entries", "gauge", [({}, semantic["entries"])]),
+                    ("chatbot_semantic_matches_total", "counter", [({}, semantic["matches"])]),
+                    ("chatbot_semantic_misses_total", "counter", [({}, semantic["misses"])])]
+
+    lines = []
+    for name, kind, values in samples:
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(f"{name}{_format_labels(sorted(labels.items()))} {value}" for labels, value in values)
+    return "\n".join(lines) + "\n"
+
+
+def render_metrics():
+    return metrics.render() + _component_metric_lines()
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_route():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/get_response_http", methods=["POST"])
 def get_response_http_route(): # Renamed to avoid conflict with internal function name
     try:
         data = request.get_json()
-        if not data or "message" not in data:
-            logging.error("Flask: Invalid request, 'message' field missing.")
-            return jsonify({"status": "error", "message": "Invalid request, 'message' field missing."}), 400
+        error = _http_message_error(data)
+        if error:
+            logging.error(f"Flask: {error}")
+            return jsonify({"status": "error", "message": error}), 400
 
         user_input_text = data["message"]
         logging.debug("Received user input in Flask: %s", user_input_text)
         
-        # For Flask, conversation history can be managed per session or be stateless.
-        # Here, we create a simple, stateless history for each request.
-        flask_conversation_history = [
-            {"role": "system", "content": "You are a helpful AI assistant responding via HTTP."},
-            {"role": "user", "content": user_input_text}
-        ]
+        try:
+            session_id, session_history, flask_conversation_history = _prepare_http_turn(data)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
         
-        llm_response = get_llm_response(flask_conversation_history, TEMPERATURE, MAX_TOKENS)
-        logging.debug("LLM response for Flask: %s", llm_response)
-        return jsonify({"status": "success", "response": llm_response})
+        use_cache = data.get("use_cache", True) # Clients may bypass the response cache
+        llm_response, served_by = route_llm_request(flask_conversation_history, TEMPERATURE, MAX_TOKENS, use_cache=use_cache)
+        logging.debug("LLM response for Flask (served by %s): %s", served_by, llm_response)
+        _record_http_turn(session_id, session_history, user_input_text, llm_response)
+        result = {"status": "success", "response": llm_response, "served_by": served_by}
+        if session_id:
+            result["session_id"] = session_id
+        return jsonify(result)
     except Exception as e:
         logging.error(f"Error in Flask route /get_response_http: {e}", exc_info=True)
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route("/get_response_stream", methods=["POST"])
+def get_response_stream_route():
+    # Same request body as /get_response_http, but the reply is a text/event-stream of a
+    # {"served_by": ...} event (plus "session_id" for stateful requests), then {"delta": ...}
+    # events, terminated by "data: [DONE]".
+    data = request.get_json(silent=True)
+    error = _http_message_error(data)
+    if error:
+        logging.error(f"Flask streaming: {error}")
+        return jsonify({"status": "error", "message": error}), 400
+
+    user_input_text = data["message"]
+    logging.debug("Received streaming user input in Flask: %s", user_input_text)
+    try:
+        session_id, session_history, flask_conversation_history = _prepare_http_turn(data)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    use_cache = data.get("use_cache", True)
+
+    def generate():
+        try:
+            served_by, deltas = route_llm_stream(flask_conversation_history, TEMPERATURE, MAX_TOKENS, use_cache=use_cache)
+            yield _sse_event({"served_by": served_by, "session_id": session_id} if session_id else {"served_by": served_by})
+            parts = []
+            for delta in deltas:
+                parts.append(delta)
+                yield _sse_event({"delta": delta})
+            _record_http_turn(session_id, session_history, user_input_text, _join_stream(parts))
+        except Exception as e:
+            logging.error(f"Error in Flask route /get_response_stream: {e}", exc_info=True)
+            yield _sse_event({"status": "error", "message": str(e)})
+        yield "data: [DONE]\n\n"
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"} # Disable proxy buffering
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers=headers)
+
+
+def cache_stats_payload():
+    # Response cache fields at the top level, with the coalescer and semantic index nested.
+    payload = {"status": "success", "enabled": response_cache is not None}
+    if response_cache is not None:
+        payload.update(response_cache.stats())
+    payload["coalescing"] = coalescing_stats()
+    payload["semantic"] = semantic_index.stats() if semantic_index is not None else {"enabled": False}
+    return payload
+
+
+@app.route("/cache_stats", methods=["GET"])
+def cache_stats_route():
+    return jsonify(cache_stats_payload())
+
+
+@app.route("/sessions/<session_id>", methods=["DELETE"])
+def delete_session_route(session_id):
+    if session_store is None or not session_store.delete(session_id):
+        return jsonify({"status": "error", "message": "Unknown session."}), 404
+    return jsonify({"status": "success", "session_id": session_id})
+
+# -----------------------------------------------------------------------------
+# Async Serving (headless, aiohttp)
+# -----------------------------------------------------------------------------
+class AsyncLLMClient:
+    # asyncio counterpart of LLMClient used by the async server. Waiting requests are
+    # coroutines rather than blocked threads, so one process can hold hundreds of them
+    # while the semaphore still caps how many reach the LLM server at once.
+    def __init__(self, endpoint, model_name, api_key=None, max_in_flight=64, pool_size=64,
+                 connect_timeout=5.0, read_timeout=150.0, queue_timeout=60.0):
+        self.endpoint = endpoint
+        self.model_name = model_name
+        self.api_key = api_key
+        self.max_in_flight = max_in_flight
+        self.pool_size = max(pool_size, max_in_flight)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.queue_timeout = queue_timeout
+        self.session = None
+        self._slots = None
+
+    async def start(self):
+        import aiohttp # Optional dependency, only needed for the async server
+        headers = {"Content-Type": "application/json"}
+        if self.api_key and self.api_key != "None" and self.api_key != "": 
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+        self._client_error = aiohttp.ClientError
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size),
+                                             headers=headers, timeout=timeout)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    def _request_data(self, conversation_history, temperature, max_tokens, stream=False):
+        return {
+            "model": self.model_name,
+            "messages": conversation_history,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": stream
+        }
+
+    async def _acquire_slot(self):
+        try:
+            with timed_stage("slot_wait"):
+                await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            logging.error(f"Async LLM client: no free request slot after {self.queue_timeout}s.")
+            return False
+
+    async def complete(self, conversation_history, temperature, max_tokens):
+        data = self._request_data(conversation_history, temperature, max_tokens, stream=False)
+        if not await self._acquire_slot():
+            return LLMError("Error: LLM server is busy. Please try again shortly.", backend_fault=False)
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            async with self.session.post(self.endpoint, data=json.dumps(data)) as response:
+                response.raise_for_status()
+                json_response = await response.json(content_type=None)
+            content = _extract_llm_content(json_response)
+            if content is not None:
+                outcome = "success"
+                return content
+            logging.error(f"Unexpected LLM response structure: {json_response}")
+            return LLMError("Error: Could not parse LLM response.")
+        except (self._client_error, asyncio.TimeoutError) as e:
+            logging.error(f"Error communicating with LLM (async): {e!r}")
+            return LLMError(f"Network Error: {e!r}")
+        except (KeyError, IndexError, TypeError) as e:
+            logging.error(f"Error parsing LLM response (async): {e}")
+            return LLMError(f"Parsing Error: {e}")
+        except json.JSONDecodeError as e:
+            logging.error(f"Error decoding JSON from LLM (async): {e}")
+            return LLMError(f"JSON Decode Error: {e}")
+        finally:
+            self._slots.release()
+            record_stage("generation", time.perf_counter() - started, model=self.model_name)
+            metrics.inc("chatbot_llm_requests_total", model=self.model_name, outcome=outcome)
+
+    async def stream(self, conversation_history, temperature, max_tokens):
+        data = self._request_data(conversation_history, temperature, max_tokens, stream=True)
+        if not await self._acquire_slot():
+            yield LLMError("Error: LLM server is busy. Please try again shortly.", backend_fault=False)
+            return
+        started = time.perf_counter()
+        received_any = False
+        outcome = "error"
+        try:
+            async with self.session.post(self.endpoint, data=json.dumps(data)) as response:
+                record_stage("connect", time.perf_counter() - started, model=self.model_name)
+                response.raise_for_status()
+                async for raw_line in response.content: # aiohttp yields one line at a time
+                    delta = _parse_sse_line(raw_line)
+                    if delta is _SSE_DONE:
+                        break
+                    if delta:
+                        if not received_any:
+                            received_any = True
+                            record_stage("ttft", time.perf_counter() - started, model=self.model_name)
+                        yield delta
+            outcome = "success"
+        except (self._client_error, asyncio.TimeoutError) as e:
+            logging.error(f"Error streaming from LLM (async): {e!r}")
+            separator = "\n\n" if received_any else "" # Keep the error apart from partial output
+            yield LLMError(f"{separator}Network Error: {e!r}")
+        finally:
+            self._slots.release()
+            record_stage("generation", time.perf_counter() - started, model=self.model_name)
+            metrics.inc("chatbot_llm_requests_total", model=self.model_name, outcome=outcome)
+
+
+class AsyncLLMRouter(LLMRouter):
+    # LLMRouter over AsyncLLMClient backends for the async server: the same backend choice,
+    # circuit breaker and failover, with awaitable complete() and an async stream(). Health
+    # checks keep running on the router's background thread with a plain HTTP probe.
+    async def start(self):
+        for backend in self.backends:
+            await backend.client.start()
+
+    async def close(self):
+        self._closed.set()
+        for backend in self.backends:
+            await backend.client.close()
+
+    def _probe_backend(self, backend):
+        response = requests.get(backend.health_url, timeout=(backend.client.connect_timeout, 5))
+        return response.status_code < 500
+
+    async def complete(self, conversation_history, temperature, max_tokens, task_type=None):
+        task_type = task_type or classify_task(conversation_history)
+        llm_response = LLMError("Error: No LLM backend available.")
+        for backend in self._candidates(task_type):
+            self._begin(backend)
+            error = _BACKEND_RAISED # Replaced once the client returns
+            try:
+                llm_response = await backend.client.complete(conversation_history, temperature, max_tokens)
+                error = llm_response if isinstance(llm_response, LLMError) else None
+            finally:
+                self._finish(backend, error)
+            if error is None:
+                logging.debug(f"Async LLM router: '{task_type}' request served by backend '{backend.name}'.")
+                return llm_response
+            logging.warning(f"Async LLM router: backend '{backend.name}' failed ({llm_response[:120]}); failing over.")
+        return llm_response
+
+    async def stream(self, conversation_history, temperature, max_tokens, task_type=None):
+        # Fails over only before the first token, like LLMRouter.stream.
+        task_type = task_type or classify_task(conversation_history)
+        last_error = LLMError("Error: No LLM backend available.")
+        for backend in self._candidates(task_type):
+            self._begin(backend)
+            deltas = backend.client.stream(conversation_history, temperature, max_tokens)
+            error = _BACKEND_RAISED # Replaced once the client yields or ends
+            try:
+                first_delta = await anext(deltas, None)
+                if isinstance(first_delta, LLMError):
+                    error = last_error = first_delta
+                    logging.warning(f"Async LLM router: backend '{backend.name}' failed ({first_delta[:120]}); "
+                                    "failing over.")
+                    continue
+                error = None
+                if first_delta is None:
+                    return
+                yield first_delta
+                async for delta in deltas:
+                    if isinstance(delta, LLMError):
+                        error = delta
+                    yield delta
+                return
+            finally:
+                await deltas.aclose()
+                self._finish(backend, error)
+        yield last_error
+
+
+def _create_async_llm_client():
+    # Uses the same [BACKEND:<name>] sections as the threaded server when any are configured.
+    backends = _configured_backends(AsyncLLMClient, ASYNC_MAX_IN_FLIGHT)
+    if not backends:
+        return AsyncLLMClient(LLM_ENDPOINT, MODEL_NAME, API_KEY,
+                              max_in_flight=ASYNC_MAX_IN_FLIGHT, pool_size=ASYNC_MAX_IN_FLIGHT,
+                              connect_timeout=LLM_CONNECT_TIMEOUT, read_timeout=LLM_READ_TIMEOUT,
+                              queue_timeout=LLM_QUEUE_TIMEOUT)
+    return AsyncLLMRouter(backends, strategy=ROUTER_STRATEGY, failure_threshold=ROUTER_FAILURE_THRESHOLD,
+                          cooldown_seconds=ROUTER_COOLDOWN_SECONDS, health_check_interval=ROUTER_HEALTH_CHECK_INTERVAL)
+
+
+async def async_route_llm_request(client, conversation_history, temperature, max_tokens, use_cache=True):
+    # Async counterpart of route_llm_request; waiting on the SymPy workers happens off the event loop.
+    local_answer = await asyncio.to_thread(_local_math_answer, conversation_history)
+    if local_answer is not None:
+        _count_route("local_math")
+        return local_answer, "local_math"
+    stored_answer, conversation_history = await asyncio.to_thread(_semantic_route, conversation_history, use_cache)
+    if stored_answer is not None:
+        _count_route("semantic_cache")
+        return stored_answer, "semantic_cache"
+    _count_route("llm")
+    llm_response = await async_get_llm_response(client, conversation_history, temperature, max_tokens, use_cache=use_cache)
+    await asyncio.to_thread(_remember_answer, conversation_history, llm_response, use_cache)
+    return llm_response, "llm"
+
+
+async def async_get_llm_response(client, conversation_history, temperature, max_tokens, use_cache=True):
+    # Async front door mirroring get_llm_response, sharing the same response cache.
+    cache_key, cached_response = _cache_lookup(conversation_history, temperature, max_tokens, use_cache)
+    if cached_response is not None:
+        return cached_response
+
+    async def complete_and_cache():
+        llm_response = await client.complete(conversation_history, temperature, max_tokens)
+        _cache_store(cache_key, llm_response)
+        return llm_response
+
+    if async_single_flight is None:
+        return await complete_and_cache()
+    return await async_single_flight.do(_flight_key(conversation_history, temperature, max_tokens), complete_and_cache)
+
+
+async def async_stream_llm_response(client, conversation_history, temperature, max_tokens, use_cache=True):
+    cache_key, cached_response = _cache_lookup(conversation_history, temperature, max_tokens, use_cache)
+    if cached_response is not None:
+        yield cached_response
+        return
+
+    async def stream_and_cache():
+        chunks = []
+        async for delta in client.stream(conversation_history, temperature, max_tokens):
+            chunks.append(delta)
+            yield delta
+        _cache_store(cache_key, _join_stream(chunks))
+
+    if async_single_flight is None:
+        deltas = stream_and_cache()
+    else:
+        deltas = async_single_flight.stream(_flight_key(conversation_history, temperature, max_tokens), stream_and_cache)
+    async for delta in deltas:
+        yield delta
+
+
+def build_async_app():
+    # Headless aiohttp application exposing the same JSON contract as the Flask routes.
+    from aiohttp import web # Optional dependency, only needed for the async server
+
+    async def get_response_http(request):
+        try:
+            data = await request.json()
+        except json.JSONDecodeError:
+            data = None
+        error = _http_message_error(data)
+        if error:
+            logging.error(f"Async server: {error}")
+            return web.json_response({"status": "error", "message": error}, status=400)
+        try:
+            user_input_text = data["message"]
+            logging.debug("Received user input in async server: %s", user_input_text)
+            try:
+                session_id, session_history, history = _prepare_http_turn(data)
+            except ValueError as e:
+                return web.json_response({"status": "error", "message": str(e)}, status=400)
+            use_cache = data.get("use_cache", True)
+            llm_response, served_by = await async_route_llm_request(request.app["llm_client"], history, TEMPERATURE,
+                                                                     MAX_TOKENS, use_cache=use_cache)
+            _record_http_turn(session_id, session_history, user_input_text, llm_response)
+            result = {"status": "success", "response": llm_response, "served_by": served_by}
+            if session_id:
+                result["session_id"] = session_id
+            return web.json_response(result)
+        except Exception as e:
+            logging.error(f"Error in async route /get_response_http: {e}", exc_info=True)
+            return web.json_response({"status": "error", "message": str(e)}, status=500)
+
+    async def get_response_stream(request):
+        try:
+            data = await request.json()
+        except json.JSONDecodeError:
+            data = None
+        error = _http_message_error(data)
+        if error:
+            logging.error(f"Async server streaming: {error}")
+            return web.json_response({"status": "error", "message": error}, status=400)
+
+        try:
+            session_id, session_history, history = _prepare_http_turn(data)
+        except ValueError as e:
+            return web.json_response({"status": "error", "message": str(e)}, status=400)
+        session_event = {"session_id": session_id} if session_id else {}
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream",
+                                               "Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        await response.prepare(request)
+        try:
+            use_cache = data.get("use_cache", True)
+            answer = await asyncio.to_thread(_local_math_answer, history)
+            served_by = "local_math" if answer is not None else "llm"
+            if answer is None:
+                answer, history = await asyncio.to_thread(_semantic_route, history, use_cache)
+                served_by = "semantic_cache" if answer is not None else "llm"
+            _count_route(served_by)
+            await response.write(_sse_event({"served_by": served_by, **session_event}).encode("utf-8"))
+            if answer is not None:
+                await response.write(_sse_event({"delta": answer}).encode("utf-8"))
+                _record_http_turn(session_id, session_history, data["message"], answer)
+            else:
+                parts = []
+                async for delta in async_stream_llm_response(request.app["llm_client"], history, TEMPERATURE, MAX_TOKENS,
+                                                             use_cache=use_cache):
+                    parts.append(delta)
+                    await response.write(_sse_event({"delta": delta}).encode("utf-8"))
+                llm_response = _join_stream(parts)
+                _record_http_turn(session_id, session_history, data["message"], llm_response)
+                await asyncio.to_thread(_remember_answer, history, llm_response, use_cache)
+        except ConnectionResetError:
+            logging.info("Async server: streaming client disconnected.")
+            return response
+        except Exception as e:
+            logging.error(f"Error in async route /get_response_stream: {e}", exc_info=True)
+            await response.write(_sse_event({"status": "error", "message": str(e)}).encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def cache_stats(request):
+        return web.json_response(cache_stats_payload())
+
+    async def metrics_endpoint(request):
+        return web.Response(text=render_metrics(), content_type="text/plain")
+
+    async def delete_session(request):
+        session_id = request.match_info["session_id"]
+        if session_store is None or not session_store.delete(session_id):
+            return web.json_response({"status": "error", "message": "Unknown session."}, status=404)
+        return web.json_response({"status": "success", "session_id": session_id})
+
+    async def start_llm_client(app):
+        app["llm_client"] = _create_async_llm_client()
+        await app["llm_client"].start()
+
+    async def close_llm_client(app):
+        await app["llm_client"].close()
+
+    async_app = web.Application()
+    async_app.router.add_post("/get_response_http", get_response_http)
+    async_app.router.add_post("/get_response_stream", get_response_stream)
+    async_app.router.add_get("/cache_stats", cache_stats)
+    async_app.router.add_get("/metrics", metrics_endpoint)
+    async_app.router.add_delete("/sessions/{session_id}", delete_session)
+    async_app.on_startup.append(start_llm_client)
+    async_app.on_cleanup.append(close_llm_client)
+    return async_app
+
+
+def run_async_server(host, port):
+    from aiohttp import web # Optional dependency, only needed for the async server
+    logging.info(f"Async server starting on http://{host}:{port}.")
+    web.run_app(build_async_app(), host=host, port=port, print=None)
+
+
+# -----------------------------------------------------------------------------
+# Batch Evaluation (headless)
+# -----------------------------------------------------------------------------
+BATCH_SYSTEM_PROMPT = "You are a helpful AI assistant that solves math problems step by step."
+_BATCH_PROMPT_FIELDS = ("message", "prompt", "question", "body")
+
+
+def _parse_batch_item(item, line_number):
+    # Accepts {"id": ..., "message"/"prompt"/"question"/"body": ...} objects or bare JSON strings.
+    if isinstance(item, str):
+        return str(line_number), item, BATCH_SYSTEM_PROMPT
+    if not isinstance(item, dict):
+        raise ValueError("each line must be a JSON object or string")
+    item_id = str(item.get("id", item.get("request_id", line_number)))
+    for field in _BATCH_PROMPT_FIELDS:
+        if item.get(field):
+            return item_id, str(item[field]), item.get("system", BATCH_SYSTEM_PROMPT)
+    raise ValueError(f"no prompt field found (expected one of {', '.join(_BATCH_PROMPT_FIELDS)})")
+
+
+def _read_batch_progress(output_path):
+    # Returns (completed_ids, invalid_line_ids): ids recorded with status "success", and the
+    # line-number ids of input lines already reported as unparseable (those have no prompt).
+    completed_ids, invalid_line_ids = set(), set()
+    if not os.path.exists(output_path):
+        return completed_ids, invalid_line_ids
+    with open(output_path, encoding="utf-8") as output_file:
+        for line in output_file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue # Partially written last line from an interrupted run
+            if record.get("status") == "success":
+                completed_ids.add(str(record.get("id")))
+            elif record.get("prompt") is None:
+                invalid_line_ids.add(str(record.get("id")))
+    return completed_ids, invalid_line_ids
+
+
+def _run_batch_item(item_id, prompt, system_prompt, temperature, max_tokens, use_cache, llm_only):
+    history = [{"role": "system", "content": system_prompt}, {"role": "user", "content": prompt}]
+    started = time.perf_counter()
+    try:
+        if llm_only:
+            response, served_by = get_llm_response(history, temperature, max_tokens, use_cache=use_cache,
+                                                   priority=PRIORITY_BATCH), "llm"
+        else:
+            response, served_by = route_llm_request(history, temperature, max_tokens, use_cache=use_cache,
+                                                    priority=PRIORITY_BATCH)
+        status = "error" if _is_llm_error(response) else "success"
+    except Exception as e:
+        logging.error(f"Batch item {item_id} failed: {e}", exc_info=True)
+        response, served_by, status = f"Critical System Error: {e}", None, "error"
+    return {
+        "id": item_id,
+        "prompt": prompt,
+        "response": response,
+        "served_by": served_by,
+        "status": status,
+        "latency_ms": round((time.perf_counter() - started) * 1000, 2)
+    }
+
+
+def run_batch(input_path, output_path, workers=4, resume=True, use_cache=True, llm_only=False,
+              temperature=TEMPERATURE, max_tokens=MAX_TOKENS):
+    # Streams prompts from a JSONL file through a worker pool and appends one JSON result per
+    # line as soon as it completes (so output order follows completion, not input). At most
+    # 2 * workers items are queued at any time, so memory stays flat however large the input.
+    # On resume, ids already recorded with status "success" are skipped and failed ones retried;
+    # an unparseable line is reported once per output file.
+    completed_ids, invalid_line_ids = _read_batch_progress(output_path) if resume else (set(), set())
+    counts = {"success": 0, "error": 0, "skipped": 0}
+    write_lock = threading.Lock()
+    pending_slots = threading.BoundedSemaphore(workers * 2)
+    started = time.perf_counter()
+
+    with open(input_path, encoding="utf-8") as input_file, \
+            open(output_path, "a" if resume else "w", encoding="utf-8") as output_file, \
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch") as pool:
+        if resume and output_file.tell() > 0:
+            with open(output_path, "rb") as existing:
+                existing.seek(-1, os.SEEK_END)
+                if existing.read(1) != b"\n":
+                    output_file.write("\n") # Terminate a line cut short by an interrupted run
+
+        def write_record(record):
+            with write_lock:
+                output_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output_file.flush()
+                counts[record["status"]] += 1
+
+        def on_item_done(future):
+            try:
+                write_record(future.result())
+            finally:
+                pending_slots.release()
+
+        for line_number, line in enumerate(input_file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item_id, prompt, system_prompt = _parse_batch_item(json.loads(line), line_number)
+            except (json.JSONDecodeError, ValueError) as e:
+                logging.error(f"Batch input line {line_number} skipped: {e}")
+                if str(line_number) in invalid_line_ids:
+                    counts["skipped"] += 1
+                    continue
+                write_record({"id": str(line_number), "prompt": None, "response": f"Error: invalid input line: {e}",
+                              "served_by": None, "status": "error", "latency_ms": 0.0})
+                continue
+            if item_id in completed_ids:
+                counts["skipped"] += 1
+                continue
+            pending_slots.acquire()
+            future = pool.submit(_run_batch_item, item_id, prompt, system_prompt, temperature, max_tokens,
+                                 use_cache, llm_only)
+            future.add_done_callback(on_item_done)
+
+    counts["elapsed_seconds"] = round(time.perf_counter() - started, 2)
+    logging.info(f"Batch run finished: {counts}")
+    return counts
+
+
 # -----------------------------------------------------------------------------
 # Main Function
 # -----------------------------------------------------------------------------
-def main():
+def run_gui():
     # Ensure 'templates' directory exists for Flask, if not, create it
     # import os
     # if not os.path.exists("templates"):
@@ -457,17 +3655,57 @@ def main():
     #         f.write("<h1>NovaChat Web (Placeholder)</h1><p>This is a basic web interface.</p>")
     #     logging.info("Created 'templates' directory and a placeholder index.html.")
 
+    _import_gui_stack()
     root = ThemedTk(theme="equilux") # equilux is a good dark theme
     chatbot_gui = ChatbotGUI(root)
     
     # Start Flask server in a separate thread
     # Use '0.0.0.0' to make it accessible on the network
-    flask_kwargs = {'host': '0.0.0.0', 'port': 5000, 'debug': False, 'use_reloader': False}
+    flask_kwargs = {'host': SERVER_HOST, 'port': SERVER_PORT, 'debug': False, 'use_reloader': False}
     flask_thread = threading.Thread(target=app.run, kwargs=flask_kwargs, daemon=True)
     flask_thread.start()
-    logging.info("Flask server starting in a daemon thread on http://0.0.0.0:5000.")
+    logging.info(f"Flask server starting in a daemon thread on http://{SERVER_HOST}:{SERVER_PORT}.")
     
     root.mainloop()
 
+
+def run_headless(host=SERVER_HOST, port=SERVER_PORT):
+    # Server-only deployments: just the Flask HTTP routes, without the Tk window or audio stack.
+    logging.info(f"Headless Flask server starting on http://{host}:{port}.")
+    app.run(host=host, port=port, debug=False, use_reloader=False, threaded=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="NovaChat math bot. Runs the Tk GUI with the Flask server by default.")
+    parser.add_argument("--headless", action="store_true",
+                        help="Run only the Flask HTTP server (no GUI, speech input or speech output).")
+    subparsers = parser.add_subparsers(dest="command")
+
+    serve_parser = subparsers.add_parser("serve-async", help="Run the headless asyncio HTTP server (requires aiohttp).")
+    serve_parser.add_argument("--host", default=SERVER_HOST)
+    serve_parser.add_argument("--port", type=int, default=SERVER_PORT)
+
+    batch_parser = subparsers.add_parser("batch", help="Run a JSONL file of prompts through the bot without the GUI.")
+    batch_parser.add_argument("input", help="JSONL file with one prompt per line.")
+    batch_parser.add_argument("output", help="JSONL file results are appended to.")
+    batch_parser.add_argument("--workers", type=int, default=LLM_MAX_IN_FLIGHT, help="Number of concurrent items.")
+    batch_parser.add_argument("--no-resume", action="store_true", help="Overwrite the output instead of resuming it.")
+    batch_parser.add_argument("--no-cache", action="store_true", help="Bypass the response cache.")
+    batch_parser.add_argument("--llm-only", action="store_true", help="Skip the local math fast-path.")
+
+    args = parser.parse_args(argv)
+    if args.command == "serve-async":
+        run_async_server(args.host, args.port)
+        return
+    if args.command == "batch":
+        counts = run_batch(args.input, args.output, workers=max(1, args.workers), resume=not args.no_resume,
+                           use_cache=not args.no_cache, llm_only=args.llm_only)
+        print(json.dumps(counts))
+        return
+    if args.headless:
+        run_headless()
+        return
+    run_gui()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
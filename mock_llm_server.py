@@ -0,0 +1,131 @@
+# mock_llm_server.py - Stand-in for LM Studio's OpenAI-compatible /v1/chat/completions
+# endpoint, for benchmarking and load-testing chatbot.py without a live model.
+#
+#   python mock_llm_server.py --port 1234 --delay 0.2 --tokens-per-second 50 --response-tokens 64
+import argparse
+import json
+import logging
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, so pooled clients are measured realistically
+
+    def log_message(self, format, *args):
+        logging.debug("Mock LLM: " + format, *args)
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/v1/models":
+            self._send_json(200, {"object": "list", "data": [{"id": self.server.model_name, "object": "model"}]})
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        try:
+            request_body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except json.JSONDecodeError as e:
+            self._send_json(400, {"error": {"message": f"Invalid JSON: {e}"}})
+            return
+
+        max_tokens = int(request_body.get("max_tokens") or self.server.response_tokens)
+        tokens = self.server.make_tokens(request_body.get("messages") or [], min(max_tokens, self.server.response_tokens))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        model = request_body.get("model") or self.server.model_name
+
+        time.sleep(self.server.delay) # Prompt processing before the first token
+        if request_body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for token in tokens:
+                chunk = {"id": completion_id, "object": "chat.completion.chunk", "model": model,
+                         "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+                self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                time.sleep(self.server.token_interval)
+            self._write_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        else:
+            time.sleep(self.server.token_interval * len(tokens))
+            self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                             "finish_reason": "stop"}],
+                "usage": {"completion_tokens": len(tokens)}
+            })
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=1234, delay=0.0, tokens_per_second=0.0, response_tokens=32,
+                 model_name="mock-model"):
+        super().__init__((host, port), MockLLMHandler)
+        self.delay = delay
+        self.token_interval = 1.0 / tokens_per_second if tokens_per_second > 0 else 0.0
+        self.response_tokens = response_tokens
+        self.model_name = model_name
+
+    def make_tokens(self, messages, count):
+        last_user_message = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "")
+        words = (f"Mock answer to: {last_user_message}".split() or ["Mock"]) + ["step"] * count
+        return [word + " " for word in words[:max(1, count)]]
+
+    @property
+    def endpoint(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+
+def start_mock_server(host="127.0.0.1", port=0, **kwargs):
+    # Starts the server on a daemon thread (port 0 picks a free port) and returns it.
+    server = MockLLMServer(host, port, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True, name="mock-llm").start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible chat completions server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1234)
+    parser.add_argument("--delay", type=float, default=0.2, help="Seconds before the first token.")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="Token rate; 0 for no pacing.")
+    parser.add_argument("--response-tokens", type=int, default=32, help="Tokens per completion.")
+    parser.add_argument("--model-name", default="mock-model")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    server = MockLLMServer(args.host, args.port, args.delay, args.tokens_per_second, args.response_tokens,
+                           args.model_name)
+    logging.info(f"Mock LLM server listening on {server.endpoint}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+# Shared pytest setup. chatbot reads config.ini and writes its log relative to the working
+# directory, so the suite runs from a scratch directory holding a copy of the repo's config.
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+_workdir = tempfile.mkdtemp(prefix="chatbot-tests-")
+shutil.copy(os.path.join(REPO_ROOT, "config.ini"), _workdir)
+os.chdir(_workdir)
+
+
+@pytest.fixture
+def mock_server():
+    from mock_llm_server import start_mock_server
+    server = start_mock_server(delay=0.05, response_tokens=8)
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def wait_until():
+    def wait(predicate, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            assert time.monotonic() < deadline, "condition not reached in time"
+            time.sleep(0.005)
+    return wait
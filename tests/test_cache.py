@@ -0,0 +1,52 @@
+import pytest
+
+import chatbot
+
+HISTORY = [{"role": "system", "content": "You are a test."}, {"role": "user", "content": "what is a prime?"}]
+
+
+class FakeClient:
+    model_name = "fake-model"
+    endpoint = "http://fake"
+
+    def __init__(self, deltas):
+        self.deltas = deltas
+
+    def stream(self, conversation_history, temperature, max_tokens):
+        yield from self.deltas
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    response_cache = chatbot.ResponseCache(max_entries=16, ttl_seconds=60)
+    monkeypatch.setattr(chatbot, "response_cache", response_cache)
+    return response_cache
+
+
+def test_stream_broken_after_partial_answer_is_not_cached(cache, monkeypatch):
+    monkeypatch.setattr(chatbot, "llm_client", FakeClient(
+        ["The answer is ", chatbot.LLMError("\n\nNetwork Error: connection reset")]))
+    deltas = list(chatbot.stream_llm_response(HISTORY, 0.0, 32))
+
+    assert chatbot._is_llm_error(chatbot._join_stream(deltas))
+    assert cache.stats()["size"] == 0
+
+
+def test_completed_stream_is_cached(cache, monkeypatch):
+    monkeypatch.setattr(chatbot, "llm_client", FakeClient(["A prime ", "has two divisors."]))
+    list(chatbot.stream_llm_response(HISTORY, 0.0, 32))
+
+    assert cache.stats()["size"] == 1
+    assert list(chatbot.stream_llm_response(HISTORY, 0.0, 32)) == ["A prime has two divisors."]
+
+
+def test_answer_starting_with_error_text_is_not_a_failure():
+    assert not chatbot._is_llm_error("Error: a common mistake is dividing by zero.")
+    assert chatbot._is_llm_error(chatbot.LLMError("Error: LLM server is busy. Please try again shortly."))
+
+
+def test_use_cache_must_be_a_json_boolean():
+    assert chatbot._http_message_error({"message": "2+2", "use_cache": False}) is None
+    assert chatbot._http_message_error({"message": "2+2"}) is None
+    assert "use_cache" in chatbot._http_message_error({"message": "2+2", "use_cache": "false"})
+    assert "use_cache" in chatbot._http_message_error({"message": "2+2", "use_cache": 0})
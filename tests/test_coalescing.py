@@ -0,0 +1,115 @@
+import threading
+
+import chatbot
+
+HISTORY = [{"role": "system", "content": "You are a test."}, {"role": "user", "content": "hello"}]
+
+
+def test_identical_calls_share_one_upstream_call(wait_until):
+    flight = chatbot.SingleFlight()
+    leader_started, release = threading.Event(), threading.Event()
+    upstream_calls, results = [], []
+
+    def upstream():
+        upstream_calls.append(1)
+        leader_started.set()
+        release.wait(5)
+        return "answer"
+
+    callers = [threading.Thread(target=lambda: results.append(flight.do("key", upstream))) for _ in range(8)]
+    callers[0].start()
+    leader_started.wait(5)
+    for caller in callers[1:]:
+        caller.start()
+    wait_until(lambda: flight.stats()["coalesced"] == 7)
+    release.set()
+    for caller in callers:
+        caller.join(5)
+
+    assert len(upstream_calls) == 1
+    assert results == ["answer"] * 8
+    assert flight.stats() == {"leaders": 1, "coalesced": 7, "in_flight": 0}
+
+
+def test_late_stream_subscriber_replays_from_the_start(wait_until):
+    flight = chatbot.SingleFlight()
+    first_chunk_sent, release = threading.Event(), threading.Event()
+
+    def upstream():
+        yield "one "
+        first_chunk_sent.set()
+        release.wait(5)
+        yield "two"
+
+    leader = flight.stream("key", upstream)
+    assert next(leader) == "one "
+    first_chunk_sent.wait(5)
+    follower = flight.stream("key", upstream)
+    follower_chunks = []
+    follower_thread = threading.Thread(target=lambda: follower_chunks.extend(follower))
+    follower_thread.start()
+    wait_until(lambda: flight.stats()["coalesced"] == 1)
+    release.set()
+    leader_rest = list(leader)
+    follower_thread.join(5)
+
+    assert leader_rest == ["two"]
+    assert follower_chunks == ["one ", "two"]
+    assert flight.stats()["leaders"] == 1
+
+
+def test_fan_out_against_mock_server(mock_server):
+    client = chatbot.LLMClient(mock_server.endpoint, "mock-model", max_in_flight=8)
+    flight = chatbot.SingleFlight()
+    results = []
+    try:
+        callers = [threading.Thread(target=lambda: results.append(
+            flight.do("hello", lambda: client.complete(HISTORY, 0.0, 32)))) for _ in range(6)]
+        for caller in callers:
+            caller.start()
+        for caller in callers:
+            caller.join(10)
+    finally:
+        client.close()
+
+    assert len(results) == 6 and len(set(results)) == 1
+    assert results[0].startswith("Mock answer to: hello")
+    stats = flight.stats()
+    assert stats["leaders"] + stats["coalesced"] == 6 and stats["coalesced"] >= 1
+
+
+def test_interactive_request_does_not_wait_behind_a_queued_batch_leader(monkeypatch, wait_until):
+    scheduler = chatbot.MicroBatchScheduler(window_ms=0, max_batch_size=8, max_parallel=1, queue_timeout=10)
+    release = threading.Event()
+    finished = []
+
+    class FakeClient:
+        def complete(self, conversation_history, temperature, max_tokens):
+            return "answer"
+
+    monkeypatch.setattr(chatbot, "request_scheduler", scheduler)
+    monkeypatch.setattr(chatbot, "single_flight", chatbot.SingleFlight())
+    monkeypatch.setattr(chatbot, "response_cache", None)
+    monkeypatch.setattr(chatbot, "llm_client", FakeClient())
+
+    def ask(priority):
+        chatbot.get_llm_response(HISTORY, 0.0, 32, priority=priority)
+        finished.append(chatbot._PRIORITY_LANES[priority])
+
+    try:
+        blocker = threading.Thread(target=scheduler.submit, args=(lambda: release.wait(5),))
+        blocker.start()
+        wait_until(lambda: scheduler.stats()["in_flight"] == 1)
+        callers = [threading.Thread(target=ask, args=(chatbot.PRIORITY_BATCH,))]
+        callers[0].start()
+        wait_until(lambda: scheduler.stats()["queued"]["batch"] == 1)
+        callers.append(threading.Thread(target=ask, args=(chatbot.PRIORITY_INTERACTIVE,)))
+        callers[1].start()
+        wait_until(lambda: scheduler.stats()["queued"]["interactive"] == 1)
+        release.set()
+        for thread in callers + [blocker]:
+            thread.join(5)
+    finally:
+        scheduler.close()
+
+    assert finished[0] == "interactive" # Its own leader in the interactive lane, not a batch follower
@@ -0,0 +1,23 @@
+import pytest
+
+import chatbot
+
+
+@pytest.fixture
+def engine():
+    return chatbot.LocalMathEngine()
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("2 + 3 * 4", "2 + 3 * 4 = 14"),
+    ("sqrt(16)", "sqrt(16) = 4"),
+    ("-(2 + 3)", "-(2 + 3) = -5"),
+    ("2 * pi", "2 * pi = 6.283185307"),
+])
+def test_arithmetic_is_answered_locally(engine, text, expected):
+    assert engine._solve_arithmetic(text).startswith(expected)
+
+
+@pytest.mark.parametrize("text", ["2023-10-17", "17-10-2023", "e", "pi", "42", "-5"])
+def test_dates_and_bare_values_are_not_calculations(engine, text):
+    assert engine._solve_arithmetic(text) is None
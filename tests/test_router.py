@@ -0,0 +1,153 @@
+import asyncio
+import socket
+
+import pytest
+
+import chatbot
+
+HISTORY = [{"role": "system", "content": "You are a test."}, {"role": "user", "content": "hello"}]
+
+
+def unused_endpoint():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}/v1/chat/completions" # Nothing listens here once the socket closes
+
+
+def make_router(mock_server):
+    backends = [chatbot.LLMBackend(name, chatbot.LLMClient(endpoint, "mock-model", connect_timeout=1.0,
+                                                           read_timeout=5.0, queue_timeout=5.0))
+                for name, endpoint in (("dead", unused_endpoint()), ("live", mock_server.endpoint))]
+    return chatbot.LLMRouter(backends, failure_threshold=1, cooldown_seconds=60.0, health_check_interval=0)
+
+
+def test_complete_fails_over_and_opens_the_dead_backend_circuit(mock_server):
+    router = make_router(mock_server)
+    try:
+        first = router.complete(HISTORY, 0.0, 32)
+        second = router.complete(HISTORY, 0.0, 32)
+        stats = router.stats()
+    finally:
+        router.close()
+
+    assert first.startswith("Mock answer to: hello")
+    assert second == first
+    assert stats["dead"]["circuit_open"]
+    assert stats["dead"]["requests"] == 1 # Skipped once its circuit opened
+    assert stats["live"]["requests"] == 2 and stats["live"]["failures"] == 0
+
+
+def test_stream_fails_over_before_the_first_token(mock_server):
+    router = make_router(mock_server)
+    try:
+        text = "".join(router.stream(HISTORY, 0.0, 32))
+        stats = router.stats()
+    finally:
+        router.close()
+
+    assert text.startswith("Mock answer to: hello")
+    assert stats["dead"]["failures"] == 1 and stats["dead"]["circuit_open"]
+
+
+def test_async_router_fails_over_and_opens_the_dead_backend_circuit(mock_server):
+    pytest.importorskip("aiohttp") # The async server is optional and needs aiohttp
+    backends = [chatbot.LLMBackend(name, chatbot.AsyncLLMClient(endpoint, "mock-model", connect_timeout=1.0,
+                                                                read_timeout=5.0, queue_timeout=5.0))
+                for name, endpoint in (("dead", unused_endpoint()), ("live", mock_server.endpoint))]
+    router = chatbot.AsyncLLMRouter(backends, failure_threshold=1, cooldown_seconds=60.0, health_check_interval=0)
+
+    async def run():
+        await router.start()
+        try:
+            answer = await router.complete(HISTORY, 0.0, 32)
+            text = "".join([delta async for delta in router.stream(HISTORY, 0.0, 32)])
+            return answer, text, router.stats()
+        finally:
+            await router.close()
+
+    answer, text, stats = asyncio.run(run())
+    assert answer.startswith("Mock answer to: hello")
+    assert text.strip() == answer
+    assert stats["dead"]["requests"] == 1 and stats["dead"]["circuit_open"]
+    assert stats["live"]["requests"] == 2 and stats["live"]["failures"] == 0
+
+
+def test_async_server_builds_a_router_from_backend_sections(monkeypatch):
+    pytest.importorskip("aiohttp")
+    monkeypatch.setattr(chatbot, "config", chatbot.configparser.ConfigParser())
+    chatbot.config.read_dict({"BACKEND:a": {"endpoint": "http://127.0.0.1:9/v1/chat/completions"},
+                              "BACKEND:b": {"endpoint": "http://127.0.0.1:10/v1/chat/completions", "tasks": "proof"}})
+    client = chatbot._create_async_llm_client()
+    assert isinstance(client, chatbot.AsyncLLMRouter)
+    assert [backend.name for backend in client.backends] == ["a", "b"]
+    client._closed.set()
+
+
+class ScriptedClient:
+    # Stands in for LLMClient: complete() returns, and stream() yields, a fixed reply.
+    endpoint = "http://127.0.0.1:9/v1/chat/completions"
+    model_name = "scripted"
+
+    def __init__(self, reply, deltas=None):
+        self.reply = reply
+        self.deltas = [reply] if deltas is None else deltas
+
+    def complete(self, conversation_history, temperature, max_tokens):
+        return self.reply
+
+    def stream(self, conversation_history, temperature, max_tokens):
+        yield from self.deltas
+
+    def close(self):
+        pass
+
+
+def scripted_router(first_client, fallback=True):
+    backends = [chatbot.LLMBackend("first", first_client)]
+    if fallback:
+        backends.append(chatbot.LLMBackend("second", ScriptedClient("fallback")))
+    return chatbot.LLMRouter(backends, failure_threshold=1, cooldown_seconds=60.0, health_check_interval=0)
+
+
+def test_local_busy_error_fails_over_without_tripping_the_circuit():
+    busy = chatbot.LLMError("Error: LLM server is busy. Please try again shortly.", backend_fault=False)
+    router = scripted_router(ScriptedClient(busy))
+    try:
+        assert router.complete(HISTORY, 0.0, 32) == "fallback"
+        assert "".join(router.stream(HISTORY, 0.0, 32)) == "fallback"
+        stats = router.stats()
+    finally:
+        router.close()
+
+    assert stats["first"]["failures"] == 0 and not stats["first"]["circuit_open"]
+    assert stats["first"]["outstanding"] == 0
+
+
+def test_answers_that_look_like_errors_and_empty_streams_are_not_backend_faults():
+    router = scripted_router(ScriptedClient("Error: a common mistake is dividing by zero.", deltas=[]), fallback=False)
+    try:
+        assert router.complete(HISTORY, 0.0, 32).startswith("Error: a common mistake")
+        assert "".join(router.stream(HISTORY, 0.0, 32)) == ""
+        stats = router.stats()
+    finally:
+        router.close()
+
+    assert stats["first"]["requests"] == 2 and stats["first"]["failures"] == 0
+    assert not stats["first"]["circuit_open"]
+
+
+def test_client_exception_counts_as_a_backend_fault():
+    class RaisingClient(ScriptedClient):
+        def complete(self, conversation_history, temperature, max_tokens):
+            raise RuntimeError("boom")
+
+    router = scripted_router(RaisingClient(""))
+    try:
+        with pytest.raises(RuntimeError):
+            router.complete(HISTORY, 0.0, 32)
+        stats = router.stats()
+    finally:
+        router.close()
+
+    assert stats["first"]["failures"] == 1 and stats["first"]["outstanding"] == 0
@@ -0,0 +1,72 @@
+import threading
+import time
+
+import chatbot
+
+
+def test_interactive_lane_overtakes_queued_batch_jobs(wait_until):
+    scheduler = chatbot.MicroBatchScheduler(window_ms=0, max_batch_size=8, max_parallel=1, queue_timeout=10)
+    release = threading.Event()
+    finished = []
+
+    def job(name):
+        def run():
+            finished.append(name)
+            return name
+        return run
+
+    try:
+        # Occupy the only worker so everything after it has to queue.
+        blocker = threading.Thread(target=scheduler.submit, args=(lambda: release.wait(5),))
+        blocker.start()
+        wait_until(lambda: scheduler.stats()["in_flight"] == 1)
+        callers = [threading.Thread(target=scheduler.submit, args=(job(f"batch-{index}"), chatbot.PRIORITY_BATCH))
+                   for index in range(3)]
+        for caller in callers:
+            caller.start()
+        wait_until(lambda: scheduler.stats()["queued"]["batch"] == 3)
+        callers.append(threading.Thread(target=scheduler.submit, args=(job("interactive"), chatbot.PRIORITY_INTERACTIVE)))
+        callers[-1].start()
+        wait_until(lambda: scheduler.stats()["queued"]["interactive"] == 1)
+        release.set()
+        for thread in callers + [blocker]:
+            thread.join(5)
+    finally:
+        scheduler.close()
+
+    assert finished[0] == "interactive"
+    assert sorted(finished[1:]) == ["batch-0", "batch-1", "batch-2"]
+
+
+def test_queue_timeout_applies_while_all_workers_are_busy(wait_until):
+    scheduler = chatbot.MicroBatchScheduler(window_ms=0, max_batch_size=8, max_parallel=1, queue_timeout=0.2)
+    release = threading.Event()
+    ran = []
+    try:
+        blocker = threading.Thread(target=scheduler.submit, args=(lambda: release.wait(5),))
+        blocker.start()
+        wait_until(lambda: scheduler.stats()["in_flight"] == 1)
+        started = time.monotonic()
+        result = scheduler.submit(lambda: ran.append(1))
+        waited = time.monotonic() - started
+        stats = scheduler.stats()
+        release.set()
+        blocker.join(5)
+        streamed = list(scheduler.submit_stream(lambda: iter(["ok"])))
+    finally:
+        scheduler.close()
+
+    assert chatbot._is_llm_error(result) and "busy" in result
+    assert waited < 1.0 # Returned on its own deadline, not when the blocker finished
+    assert stats["expired"] == 1 and stats["queued"]["default"] == 0
+    assert ran == [] # The withdrawn job never runs
+    assert streamed == ["ok"]
+
+
+def test_stream_jobs_yield_deltas_in_order():
+    scheduler = chatbot.MicroBatchScheduler(window_ms=0, max_batch_size=8, max_parallel=2, queue_timeout=10)
+    try:
+        deltas = list(scheduler.submit_stream(lambda: iter(["a", "b", "c"]), chatbot.PRIORITY_INTERACTIVE))
+    finally:
+        scheduler.close()
+    assert deltas == ["a", "b", "c"]
@@ -0,0 +1,82 @@
+import pytest
+
+import chatbot
+
+
+def make_index():
+    pytest.importorskip("numpy") # Semantic reuse is optional and needs NumPy
+    index = chatbot.SemanticAnswerIndex(embedding_model="hashing", threshold=0.9, max_entries=16)
+    index.add("What is the derivative of x^2?", "2*x")
+    index.add("Is sqrt 2 irrational?", "Yes.")
+    return index
+
+
+def test_rewording_reuses_the_stored_answer():
+    match = make_index().lookup("find the derivative of x squared")
+    assert match is not None and match["answer"] == "2*x"
+
+
+def test_single_letter_variables_are_not_stopwords():
+    assert make_index().lookup("What is the derivative of a x^2?") is None
+
+
+def test_hashing_embedder_requires_the_same_words():
+    assert make_index().lookup("Is sqrt 2 rational?") is None
+
+
+def test_answers_are_not_shared_across_system_prompts():
+    gui_history = [{"role": "system", "content": "You are Nova."}, {"role": "user", "content": "what is a prime?"}]
+    batch_history = [{"role": "system", "content": "Answer with a number only."}, gui_history[1]]
+    gui_key, batch_key = chatbot._system_prompt_key(gui_history), chatbot._system_prompt_key(batch_history)
+    index = make_index()
+    index.add("what is a prime?", "A number with two divisors.", gui_key)
+
+    assert gui_key != batch_key
+    assert index.lookup("what is a prime", batch_key) is None
+    assert index.lookup("what is a prime", gui_key)["answer"] == "A number with two divisors."
+
+
+def test_only_accepted_matches_are_counted():
+    index = make_index()
+    index.lookup("Is sqrt 2 rational?")
+    index.lookup("is sqrt 2 irrational")
+    stats = index.stats()
+    assert (stats["matches"], stats["misses"]) == (1, 1)
+
+
+# The reuse rules below need no NumPy, so they run even where the index tests are skipped.
+def test_rewordings_normalize_to_the_same_text():
+    normalized = chatbot._normalize_question("What's the derivative of x squared?")
+    assert normalized == chatbot._normalize_question("find the derivative of x^2")
+    assert chatbot._math_signature(normalized) == ("x", "^", "2")
+
+
+def test_math_signature_keeps_variables_and_numbers():
+    signature = chatbot._math_signature(chatbot._normalize_question("derivative of a x^2"))
+    assert signature == ("a", "x", "^", "2")
+    assert signature != chatbot._math_signature(chatbot._normalize_question("derivative of x^3"))
+
+
+def test_reuse_rule_requires_same_prompt_math_and_words():
+    index = chatbot.SemanticAnswerIndex()
+    index._embedder = chatbot.HashingEmbedder() # Set directly; no vectors are needed for the rule itself
+
+    def accepts(stored_question, question, stored_key="k", key="k"):
+        stored = (stored_question, "answer", (stored_key,) + chatbot._math_signature(
+            chatbot._normalize_question(stored_question)))
+        normalized = chatbot._normalize_question(question)
+        return index._same_question(stored, normalized, (key,) + chatbot._math_signature(normalized))
+
+    assert accepts("Is sqrt 2 irrational?", "is sqrt 2 irrational")
+    assert not accepts("Is sqrt 2 irrational?", "Is sqrt 2 rational?")
+    assert not accepts("what is 2+2", "what is 2+3")
+    assert not accepts("what is 2+2", "what is 2+2", stored_key="other")
+
+
+def test_follow_up_turns_are_not_standalone():
+    system = {"role": "system", "content": "You are a test."}
+    user = {"role": "user", "content": "is sqrt 2 irrational"}
+    assert chatbot._is_standalone_question([system, user])
+    assert not chatbot._is_standalone_question([system, {"role": "assistant", "content": "..."}, user])
+    summary = {"role": "system", "content": f"{chatbot.HISTORY_SUMMARY_PREFIX} earlier turns"}
+    assert not chatbot._is_standalone_question([system, summary, user])
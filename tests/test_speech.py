@@ -0,0 +1,23 @@
+import pytest
+
+import chatbot
+
+
+def test_missing_local_backend_disables_voice_input_instead_of_going_online(monkeypatch, tmp_path):
+    monkeypatch.setattr(chatbot, "STT_VOSK_MODEL_PATH", str(tmp_path / "no-model"))
+    monkeypatch.setattr(chatbot, "STT_ALLOW_ONLINE_FALLBACK", False)
+    with pytest.raises(RuntimeError, match="allow_online_fallback"):
+        chatbot.create_speech_backend("vosk")
+    with pytest.raises(RuntimeError):
+        chatbot.create_speech_backend("whisper")
+
+
+def test_online_fallback_is_opt_in(monkeypatch, tmp_path):
+    monkeypatch.setattr(chatbot, "STT_VOSK_MODEL_PATH", str(tmp_path / "no-model"))
+    monkeypatch.setattr(chatbot, "STT_ALLOW_ONLINE_FALLBACK", True)
+    assert isinstance(chatbot.create_speech_backend("vosk"), chatbot.GoogleSpeechBackend)
+
+
+def test_google_is_used_when_configured_explicitly(monkeypatch):
+    monkeypatch.setattr(chatbot, "STT_ALLOW_ONLINE_FALLBACK", False)
+    assert isinstance(chatbot.create_speech_backend("google"), chatbot.GoogleSpeechBackend)
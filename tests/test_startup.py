@@ -0,0 +1,28 @@
+# Headless import budget: importing chatbot must stay fast and must not pull in the GUI or
+# audio stacks. Override the budget with CHATBOT_IMPORT_BUDGET_MS on slow machines.
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+import benchmark
+from conftest import REPO_ROOT
+
+IMPORT_BUDGET_MS = float(os.environ.get("CHATBOT_IMPORT_BUDGET_MS", 1000))
+
+
+def probe_import():
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])))
+    completed = subprocess.run([sys.executable, "-c", benchmark.STARTUP_PROBE], env=env,
+                               capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def test_import_loads_no_gui_or_audio_modules():
+    assert probe_import()["gui_modules"] == []
+
+
+def test_median_import_time_within_budget():
+    import_ms = [probe_import()["import_ms"] for _ in range(3)]
+    assert statistics.median(import_ms) < IMPORT_BUDGET_MS